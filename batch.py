@@ -0,0 +1,147 @@
+import argparse
+import json
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fetch_txs import module, get_confirmation_height
+from feature_store import FeatureWriter
+from fingerprinting import Wallets, detect_wallet_from_features, get_features, get_wallet_label
+from raw_tx import is_txid, tx_from_raw
+from results import ResultTable
+
+# Streams txids (or raw transaction hex) from a file or stdin and writes one
+# JSON verdict per line as soon as it is classified. At most `window`
+# transactions are in flight at once and only the per-wallet counts are kept,
+# so memory use does not grow with the size of the input. With --results the
+# verdicts are also collected into a compact ResultTable (see results.py),
+# which costs a few dozen bytes per transaction.
+
+def read_inputs(stream):
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+# A raw transaction is decoded locally and only the transactions it spends
+# from are fetched, so it doesn't have to have been broadcast. Its height is
+# looked up with `get_height`, and taken to be unconfirmed if that fails.
+def tx_from_line(line, get_tx, get_raw_tx, get_height):
+    if is_txid(line):
+        return get_tx(line.lower())
+
+    tx = tx_from_raw(line, get_raw_tx)
+    try:
+        height = get_height(tx["txid"])
+    except Exception:
+        height = -1
+    if height == -1:
+        tx["status"] = {"confirmed": False}
+    else:
+        tx["status"] = {"confirmed": True, "block_height": height}
+    return tx
+
+# Returns the verdict and the features it was based on (None on errors)
+def classify_line(line, get_tx, get_raw_tx, get_height):
+    try:
+        tx = tx_from_line(line, get_tx, get_raw_tx, get_height)
+        txid = tx["txid"]
+        features = get_features(tx)
+        wallet, reasoning = detect_wallet_from_features(features)
+    except Exception as e:
+        return {"input": line[:64], "error": str(e)}, None
+
+    verdict = {
+        "txid": txid,
+        "wallet": get_wallet_label(wallet).value,
+        "candidates": sorted(w.value for w in wallet),
+        "reasoning": reasoning,
+        "height": features["height"],
+        # what clustering.py needs to link transactions
+        "inputs": [[tx_in["txid"], tx_in["vout"], tx_in["prevout"]["scriptpubkey"]] for tx_in in tx["vin"]],
+        "change_index": features["change_index"],
+    }
+    return verdict, features
+
+# If a ResultTable is passed in as `results`, every successful verdict is also
+# appended to it, and if a FeatureWriter is passed in as `features`, the
+# features behind each verdict are written to it
+def classify_stream(lines, out, window=16, get_tx=None, results=None, features=None,
+                    get_raw_tx=None, get_height=None):
+    if get_tx is None:
+        get_tx = module.get_tx
+    if get_raw_tx is None:
+        # looked up when first used, so the backend is only picked if needed
+        get_raw_tx = lambda txid: module.getrawtransaction(txid)
+    if get_height is None:
+        get_height = get_confirmation_height
+
+    totals = {wallet_type.value: 0 for wallet_type in Wallets}
+    totals["Error"] = 0
+
+    def emit(result):
+        verdict, tx_features = result
+        if features is not None and tx_features is not None:
+            try:
+                features.write(tx_features)
+            except Exception as e:
+                verdict = {"input": verdict["txid"], "error": f"could not store features: {e}"}
+        totals[verdict.get("wallet", "Error")] += 1
+        if results is not None and "wallet" in verdict:
+            results.append(
+                verdict["txid"],
+                {Wallets(value) for value in verdict["candidates"]},
+                verdict["reasoning"],
+                verdict["height"],
+            )
+        out.write(json.dumps(verdict) + "\n")
+        out.flush()
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for line in lines:
+            if len(in_flight) >= window:
+                emit(in_flight.popleft().result())
+            in_flight.append(executor.submit(classify_line, line, get_tx, get_raw_tx, get_height))
+
+        while in_flight:
+            emit(in_flight.popleft().result())
+
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify a stream of transactions, one JSON verdict per line.")
+    parser.add_argument("input", nargs="?", default="-", help="file of txids or raw transaction hex, one per line (default: stdin)")
+    parser.add_argument("-o", "--output", default="-", help="file to write verdicts to (default: stdout)")
+    parser.add_argument("-w", "--window", type=int, default=16, help="maximum number of transactions in flight")
+    parser.add_argument("--results", help="also save the verdicts as a columnar result table in this directory")
+    parser.add_argument("--features", help="append the features of each transaction to this file, see feature_store.py")
+    args = parser.parse_args(argv)
+
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+
+    results = ResultTable() if args.results else None
+    features = FeatureWriter(args.features) if args.features else None
+
+    try:
+        totals = classify_stream(read_inputs(infile), outfile, window=args.window, results=results, features=features)
+        outfile.write(json.dumps({"totals": totals}) + "\n")
+        if hasattr(module, "report"):
+            # health and latency of each source when using a HedgedBackend
+            print(json.dumps(module.report()), file=sys.stderr)
+        if results is not None:
+            results.save(args.results)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+        if features is not None:
+            features.close()
+
+if __name__ == '__main__':
+    main()
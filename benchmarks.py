@@ -0,0 +1,125 @@
+import argparse
+import time
+from collections import Counter
+
+from fingerprinting import detect_wallet, get_spending_types, get_wallet_label
+from output_index import set_active_index
+from raw_tx import scan_inputs
+from synthetic import SyntheticChain
+
+# Benchmarks that run entirely offline. Run with `python benchmarks.py`.
+
+# low_r_only / compressed_public_keys_only as they were before scan_inputs,
+# kept here unchanged as a baseline. They only handle P2PKH and P2WPKH.
+def legacy_compressed_public_keys_only(tx):
+    input_types = get_spending_types(tx)
+    for i, input_type in enumerate(input_types):
+        if input_type == "witness_v0_keyhash" or input_type == "v0_p2wpkh":
+            if tx["vin"][i]["witness"][1][1] == '4':
+                return False
+        elif input_type == "pubkeyhash" or input_type == "p2pkh":
+            if tx["vin"][i]["scriptsig_asm"][tx["vin"][i]["scriptsig_asm"].find(" ") + 2] == '4':
+                return False
+    return True
+
+def legacy_low_r_only(tx):
+    input_types = get_spending_types(tx)
+    for i, input_type in enumerate(input_types):
+        if input_type == "witness_v0_keyhash":
+            r_len = tx["vin"][i]["witness"][0][6:8]
+            if int(r_len, 16) > 32:
+                return False
+        elif input_type == "pubkeyhash":
+            r_len = tx["vin"][i]["scriptsig_asm"][6:8]
+            if int(r_len, 16) > 32:
+                return False
+        elif input_type == "p2pkh":
+            signature = tx["vin"][i]["scriptsig_asm"].split(' ')[1]
+            r_len = signature[6:8]
+            if int(r_len, 16) > 32:
+                return False
+        elif input_type == "v0_p2wpkh":
+            r_len = tx["vin"][i]["witness"][0][6:8]
+            if int(r_len, 16) > 32:
+                return False
+
+    return True
+
+def make_p2wpkh_input(i):
+    r = f"{i % 0x7f:02x}" * 32
+    signature = "3044" + "0220" + r + "0220" + "22" * 32 + "01"
+    return {
+        "txid": f"{i:064x}",
+        "vout": 0,
+        "scriptsig": "",
+        "scriptsig_asm": "",
+        "witness": [signature, "02" + "33" * 32],
+        "prevout": {"scriptpubkey": "0014" + "44" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 0.001},
+    }
+
+def timed(function, *args, repeat=20):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_signature_scan(num_inputs):
+    tx = {"vin": [make_p2wpkh_input(i) for i in range(num_inputs)]}
+
+    def legacy(tx):
+        legacy_low_r_only(tx)
+        legacy_compressed_public_keys_only(tx)
+
+    legacy_time = timed(legacy, tx)
+    scan_time = timed(scan_inputs, tx)
+    print(f"signature scan, {num_inputs} P2WPKH inputs")
+    print(f"  string slicing (low-r + compressed): {legacy_time * 1000:.2f} ms")
+    print(f"  scan_inputs (all input types):       {scan_time * 1000:.2f} ms")
+
+# Classifies synthetic transactions and checks the verdicts against the
+# wallet that generated them
+def bench_classification(num_txs, seed=0):
+    chain = SyntheticChain(seed=seed)
+    set_active_index(chain.index)
+
+    generate_time = 0
+    classify_time = 0
+    totals = Counter()
+    correct = Counter()
+
+    start = time.perf_counter()
+    for tx, wallet in chain.iter_transactions(num_txs):
+        generated = time.perf_counter()
+        label = get_wallet_label(detect_wallet(tx)[0])
+        classified = time.perf_counter()
+
+        generate_time += generated - start
+        classify_time += classified - generated
+        start = classified
+
+        totals[wallet] += 1
+        if label == wallet:
+            correct[wallet] += 1
+
+    set_active_index(None)
+    chain.index.close()
+
+    print(f"classification, {num_txs} synthetic transactions")
+    print(f"  generation:     {generate_time:.2f} s")
+    print(f"  classification: {classify_time:.2f} s ({num_txs / classify_time:.0f} tx/s)")
+    print(f"  accuracy:       {sum(correct.values()) / num_txs:.2%}")
+    for wallet, total in sorted(totals.items(), key=lambda item: item[0].value):
+        print(f"    {wallet.value:<16} {correct[wallet] / total:.2%} of {total}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run offline benchmarks.")
+    parser.add_argument("--inputs", type=int, default=5000, help="number of inputs in the signature scan benchmark")
+    parser.add_argument("--txs", type=int, nargs="+", default=[1000, 10000, 100000], help="numbers of synthetic transactions to classify")
+    args = parser.parse_args()
+
+    bench_signature_scan(args.inputs)
+    for num_txs in args.txs:
+        bench_classification(num_txs)
@@ -8,10 +8,13 @@ Config.read("rpc_config.ini")
 URL = Config.get("RPC_INFO", "URL")
 RPCUSER = Config.get("RPC_INFO", "RPCUSER")
 RPCPASSWORD = Config.get("RPC_INFO", "RPCPASSWORD")
+# seconds to wait for the node to connect and to send each part of a reply,
+# so a stalled request fails instead of holding on to a worker thread
+TIMEOUT = Config.getfloat("RPC_INFO", "TIMEOUT", fallback=30)
 
 class BitcoinCore:
-    def __init__(self):
-        pass
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
 
     def get_prev_txout(self, tx_in):
         prev_txout = self.decoderawtransaction(self.getrawtransaction(tx_in["txid"]))["vout"][tx_in["vout"]]
@@ -47,34 +50,58 @@ class BitcoinCore:
     def getbestblockhash(self):
         payload = json.dumps({"method": "getbestblockhash", "params": []})
         headers = {'content-type': "application/json", 'cache-control': "no-cache"}
-        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD))
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
 
         return json.loads(response.text)["result"]
 
     def getblocktxs(self, block_hash):
         payload = json.dumps({"method": "getblock", "params": [block_hash]})
         headers = {'content-type': "application/json", 'cache-control': "no-cache"}
-        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD))
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
 
         return json.loads(response.text)["result"]["tx"]
 
+    def getblockheight(self, block_hash):
+        payload = json.dumps({"method": "getblockheader", "params": [block_hash]})
+        headers = {'content-type': "application/json", 'cache-control': "no-cache"}
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
+
+        return json.loads(response.text)["result"]["height"]
+
+    # -1 if the transaction hasn't confirmed yet. Needs -txindex for
+    # transactions that aren't in the node's wallet or mempool
+    def getconfirmationheight(self, txid):
+        payload = json.dumps({"method": "getrawtransaction", "params": [txid, True]})
+        headers = {'content-type': "application/json", 'cache-control': "no-cache"}
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
+
+        reply = json.loads(response.text)
+        if reply.get("error"):
+            # most likely the transaction isn't in the node's mempool or
+            # wallet and -txindex is off
+            raise RuntimeError(f"getrawtransaction {txid} failed: {reply['error'].get('message')}")
+        tx = reply["result"]
+        if "blockhash" not in tx:
+            return -1
+        return self.getblockheight(tx["blockhash"])
+
     def getrawmempool(self):
         payload = json.dumps({"method": "getrawmempool", "params": []})
         headers = {'content-type': "application/json", 'cache-control': "no-cache"}
-        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD))
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
 
         return json.loads(response.text)["result"]
 
     def getrawtransaction(self, txid):
         payload = json.dumps({"method": "getrawtransaction", "params": [txid]})
         headers = {'content-type': "application/json", 'cache-control': "no-cache"}
-        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD))
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
 
         return json.loads(response.text)["result"]
 
     def decoderawtransaction(self, tx_hex):
         payload = json.dumps({"method": "decoderawtransaction", "params": [tx_hex]})
         headers = {'content-type': "application/json", 'cache-control': "no-cache"}
-        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD))
+        response = requests.request("POST", URL, data=payload, headers=headers, auth=(RPCUSER, RPCPASSWORD), timeout=self.timeout)
 
         return json.loads(response.text)["result"]
@@ -0,0 +1,245 @@
+import argparse
+import json
+import sys
+from array import array
+
+import numpy as np
+
+from fingerprinting import Wallets
+from results import LABEL_TABLE, WALLETS, WALLET_BITS
+
+# Groups transactions that must have been made by the same wallet software
+# and intersects their candidate wallets, which can narrow down transactions
+# that were unclear on their own. Two links are used:
+#
+#   - common input ownership: inputs spending from the same scriptPubKey
+#     belong to the same wallet, so their transactions are joined
+#   - change: a transaction spending the change output of another was made by
+#     the wallet that created it
+#
+# Transactions are numbered in the order they are added and the disjoint-set
+# forest is kept in flat typed arrays. The change outputs and input
+# scriptPubKeys seen so far are kept as 64 bit hashes in sorted numpy arrays
+# (see HashRuns), 16 bytes per change output and per distinct script, so
+# there are no per-transaction Python objects. Inputs are buffered and linked
+# a chunk at a time.
+#
+# A change link is only made if the transaction that created the change was
+# added before the one spending it, or in the same chunk. batch.py writes
+# verdicts in input order, so transactions should be fed in block order.
+
+ALL_WALLETS_MASK = (1 << len(WALLETS)) - 1
+UNCLEAR = WALLETS.index(Wallets.UNCLEAR)
+OTHER = WALLETS.index(Wallets.OTHER)
+# number of inputs buffered before they are linked
+CHUNK_SIZE = 1 << 16
+
+def wallet_mask(possible_wallets):
+    mask = 0
+    for wallet in possible_wallets:
+        mask |= WALLET_BITS[wallet]
+    return mask
+
+# A map from 64 bit hashes to transaction numbers, kept as sorted runs
+# (largest first). Each batch of keys added becomes a run, merged with the
+# previous one once it is as large, so a lookup searches a logarithmic
+# number of runs.
+class HashRuns:
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(keys) for keys, nodes in self.runs)
+
+    # Returns the transaction for each key, -1 where there is none
+    def lookup(self, keys):
+        found = np.full(len(keys), -1, dtype=np.int64)
+        for run_keys, run_nodes in self.runs:
+            positions = np.minimum(np.searchsorted(run_keys, keys), len(run_keys) - 1)
+            hit = (run_keys[positions] == keys) & (found == -1)
+            found[hit] = run_nodes[positions[hit]]
+        return found
+
+    def add(self, keys, nodes):
+        while self.runs and len(self.runs[-1][0]) <= len(keys):
+            last_keys, last_nodes = self.runs.pop()
+            keys = np.concatenate((last_keys, keys))
+            nodes = np.concatenate((last_nodes, nodes))
+        if len(keys):
+            order = np.argsort(keys, kind="stable")
+            self.runs.append((keys[order], nodes[order]))
+
+def take(buffer):
+    return np.frombuffer(buffer, dtype=np.int64)
+
+class WalletClusters:
+    def __init__(self):
+        self.parent = array("q")
+        self.rank = array("B")
+        self.masks = array("H")
+        # hash of a change outpoint -> transaction that created it
+        self.change_outputs = HashRuns()
+        # hash of an input scriptPubKey -> first transaction that spent from it
+        self.input_scripts = HashRuns()
+        # (hash, transaction) pairs not linked yet
+        self.pending_change = (array("q"), array("q"))
+        self.pending_spends = (array("q"), array("q"))
+        self.pending_scripts = (array("q"), array("q"))
+
+    def __len__(self):
+        return len(self.parent)
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            # path halving
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+    def union_all(self, a, b):
+        differ = (a != b) & (b != -1)
+        for node, other in zip(a[differ].tolist(), b[differ].tolist()):
+            self.union(node, other)
+
+    # `inputs` is a list of (txid, vout, scriptPubKey hex) for the outpoints
+    # the transaction spends. Returns the number given to the transaction.
+    def add(self, txid, possible_wallets, inputs, change_index=-1):
+        node = len(self.parent)
+        self.parent.append(node)
+        self.rank.append(0)
+        self.masks.append(wallet_mask(possible_wallets))
+
+        spends, spenders = self.pending_spends
+        scripts, spenders_of_scripts = self.pending_scripts
+        for prev_txid, vout, scriptpubkey in inputs:
+            spends.append(hash((prev_txid.lower(), vout)))
+            spenders.append(node)
+            scripts.append(hash(scriptpubkey))
+            spenders_of_scripts.append(node)
+
+        if change_index >= 0:
+            self.pending_change[0].append(hash((txid.lower(), change_index)))
+            self.pending_change[1].append(node)
+
+        if len(spends) >= CHUNK_SIZE:
+            self.flush()
+        return node
+
+    # Links the buffered transactions with each other and with the earlier
+    # ones. roots() does this first, so it only needs to be called directly
+    # before using find().
+    def flush(self):
+        change, creators = (take(buffer) for buffer in self.pending_change)
+        spends, spenders = (take(buffer) for buffer in self.pending_spends)
+        scripts, nodes = (take(buffer) for buffer in self.pending_scripts)
+        self.pending_change = (array("q"), array("q"))
+        self.pending_spends = (array("q"), array("q"))
+        self.pending_scripts = (array("q"), array("q"))
+
+        # change first, so it can be spent within the same chunk
+        self.change_outputs.add(change, creators)
+        self.union_all(spenders, self.change_outputs.lookup(spends))
+
+        if not len(scripts):
+            return
+        # stable, so the first spender in the chunk comes first
+        order = np.argsort(scripts, kind="stable")
+        scripts = scripts[order]
+        nodes = nodes[order]
+        first = np.ones(len(scripts), dtype=bool)
+        first[1:] = scripts[1:] != scripts[:-1]
+        new_scripts = scripts[first]
+        new_nodes = nodes[first]
+        # every input joins the first spender in the chunk, which joins the
+        # first spender before this chunk if there was one
+        self.union_all(nodes, new_nodes[np.cumsum(first) - 1])
+        owners = self.input_scripts.lookup(new_scripts)
+        self.union_all(new_nodes, owners)
+        is_new = owners == -1
+        self.input_scripts.add(new_scripts[is_new], new_nodes[is_new])
+
+    # Root of every transaction, found for all of them at once by pointer
+    # jumping instead of one find() at a time
+    def roots(self):
+        self.flush()
+        roots = np.frombuffer(self.parent, dtype=np.int64).copy()
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                return roots
+            roots = jumped
+
+    # Returns the label of every transaction on its own and after
+    # intersecting the candidates of its cluster, as indexes into WALLETS
+    def labels(self, roots=None):
+        if roots is None:
+            roots = self.roots()
+        masks = np.frombuffer(self.masks, dtype=np.uint16)
+        cluster_masks = np.full(len(masks), ALL_WALLETS_MASK, dtype=np.uint16)
+        np.bitwise_and.at(cluster_masks, roots, masks)
+        return LABEL_TABLE[masks], LABEL_TABLE[cluster_masks[roots]]
+
+    def report(self):
+        roots = self.roots()
+        before, after = self.labels(roots)
+        cluster_sizes = np.bincount(roots, minlength=len(self))
+
+        unclear = before == UNCLEAR
+        return {
+            "transactions": len(self),
+            "clusters": int(np.count_nonzero(cluster_sizes)),
+            "largest_cluster": int(cluster_sizes.max()) if len(self) else 0,
+            "unclear": int(np.count_nonzero(unclear)),
+            "resolved": int(np.count_nonzero(unclear & (after != UNCLEAR) & (after != OTHER))),
+            # transactions whose cluster has no wallet in common
+            "conflicting": int(np.count_nonzero((before != OTHER) & (after == OTHER))),
+            "totals": {
+                wallet.value: int(count)
+                for wallet, count in zip(WALLETS, np.bincount(after, minlength=len(WALLETS)))
+            },
+        }
+
+# Builds clusters from the JSONL written by batch.py in a single pass
+def cluster_verdicts(lines):
+    clusters = WalletClusters()
+    for line in lines:
+        verdict = json.loads(line)
+        if "candidates" not in verdict:
+            # error lines and the totals at the end
+            continue
+        clusters.add(
+            verdict["txid"],
+            {Wallets(value) for value in verdict["candidates"]},
+            verdict["inputs"],
+            verdict["change_index"],
+        )
+    return clusters
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cluster the verdicts written by batch.py and report how many unclear transactions were resolved.")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL file written by batch.py (default: stdin)")
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    try:
+        clusters = cluster_verdicts(infile)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+
+    print(json.dumps(clusters.report(), indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from fingerprinting import (
+    SCRIPT_TYPES,
+    InputSortingType,
+    detect_wallet_from_features,
+)
+from results import ResultTable
+
+# Stores the output of get_features as fixed-width records, appended to a
+# flat file and read back with np.memmap. Re-running detect_wallet_from_features
+# over the file re-evaluates changed rules without any network calls.
+#
+# What can be replayed is whatever is computed from the stored features:
+# every rule in detect_wallet_from_features, anti-fee-sniping (the height is
+# always stored) and the output structure, which is worked out from the
+# stored output order flags and change index. The observations themselves
+# can't be changed after the fact: the change index, the input order flags
+# (ascending, descending, BIP-69, historical) and the signature checks need
+# the transactions to be fetched again.
+#
+# Sets of script types and sorting/structure types are stored as bitmasks in
+# the order of SCRIPT_TYPES and the enums. Heuristics that can be unknown
+# (None) are stored as -1. nVersion is stored as the unsigned 32 bit field it
+# is on the wire, whichever way the backend reports it.
+
+FEATURE_DTYPE = np.dtype([
+    ("txid", np.uint8, (32,)),
+    ("version", "<u4"),
+    ("locktime", "<u4"),
+    ("height", "<i4"),
+    ("num_inputs", "<u4"),
+    ("num_outputs", "<u4"),
+    ("input_types", "<u2"),
+    ("output_types", "<u2"),
+    ("signals_rbf", "?"),
+    ("low_r_only", "?"),
+    ("compressed_public_keys_only", "?"),
+    ("address_reuse", "?"),
+    ("change_address_reused", "i1"),
+    ("spends_unconfirmed", "i1"),
+    ("change_index", "<i4"),
+    ("change_type_matched_inputs", "i1"),
+    ("input_order", "u1"),
+    ("output_amounts_sorted", "?"),
+    ("output_amounts_distinct", "?"),
+    ("output_scripts_sorted", "?"),
+])
+
+INPUT_SORTING_TYPES = list(InputSortingType)
+
+def _to_mask(values, order):
+    mask = 0
+    for value in values:
+        mask |= 1 << order.index(value)
+    return mask
+
+def _from_mask(mask, order):
+    return [value for i, value in enumerate(order) if mask & (1 << i)]
+
+def _optional_bool(value):
+    if value is None:
+        return -1
+    return int(value)
+
+def to_record(features):
+    record = np.zeros((), dtype=FEATURE_DTYPE)
+    record["txid"] = np.frombuffer(bytes.fromhex(features["txid"]), dtype=np.uint8)
+    record["version"] = features["version"] & 0xffffffff
+    for name in ("locktime", "height", "num_inputs", "num_outputs", "change_index",
+                 "change_type_matched_inputs", "signals_rbf", "low_r_only",
+                 "compressed_public_keys_only", "address_reuse", "output_amounts_sorted",
+                 "output_amounts_distinct", "output_scripts_sorted"):
+        record[name] = features[name]
+    record["input_types"] = _to_mask(features["input_types"], SCRIPT_TYPES)
+    record["output_types"] = _to_mask(features["output_types"], SCRIPT_TYPES)
+    record["change_address_reused"] = _optional_bool(features["change_address_reused"])
+    record["spends_unconfirmed"] = _optional_bool(features["spends_unconfirmed"])
+    record["input_order"] = _to_mask(features["input_order"], INPUT_SORTING_TYPES)
+    return record
+
+class FeatureWriter:
+    def __init__(self, path, append=True):
+        self.file = open(path, "ab" if append else "wb")
+
+    def write(self, features):
+        self.file.write(to_record(features).tobytes())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def load_features(path):
+    # np.memmap can't map an empty file
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=FEATURE_DTYPE)
+    return np.memmap(path, dtype=FEATURE_DTYPE, mode="r")
+
+# Turns records back into the dicts detect_wallet_from_features expects.
+# Columns are converted to Python lists a chunk at a time, which is much
+# faster than reading the records field by field.
+def iter_features(records, chunk_size=100000):
+    script_types = {}
+    input_orders = {}
+
+    def decode(cache, mask, order, convert):
+        if mask not in cache:
+            cache[mask] = convert(_from_mask(mask, order))
+        return cache[mask]
+
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        columns = {name: chunk[name].tolist() for name in FEATURE_DTYPE.names if name != "txid"}
+        txids = np.ascontiguousarray(chunk["txid"]).tobytes().hex()
+
+        for i in range(len(chunk)):
+            features = {name: column[i] for name, column in columns.items()}
+            features["txid"] = txids[64 * i:64 * (i + 1)]
+            features["input_types"] = decode(script_types, features["input_types"], SCRIPT_TYPES, frozenset)
+            features["output_types"] = decode(script_types, features["output_types"], SCRIPT_TYPES, frozenset)
+            features["input_order"] = decode(input_orders, features["input_order"], INPUT_SORTING_TYPES, list)
+            for name in ("change_address_reused", "spends_unconfirmed"):
+                if features[name] == -1:
+                    features[name] = None
+            yield features
+
+# Classifies every transaction in a feature file with the current rules
+def replay(path, detect=detect_wallet_from_features):
+    records = load_features(path)
+    table = ResultTable(capacity=max(1, len(records)))
+    for features in iter_features(records):
+        wallet, reasoning = detect(features)
+        table.append(features["txid"], wallet, reasoning, features["height"])
+    return table
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-run wallet detection over a feature file written by batch.py.")
+    parser.add_argument("features", help="feature file written with batch.py --features")
+    parser.add_argument("--results", help="also save the verdicts as a columnar result table in this directory")
+    args = parser.parse_args(argv)
+
+    table = replay(args.features)
+    if args.results:
+        table.save(args.results)
+    print(json.dumps(table.totals(), indent=4))
+
+if __name__ == '__main__':
+    main()
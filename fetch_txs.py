@@ -1,22 +1,69 @@
+import configparser
 import requests
-import json
+import sys
+import threading
 from bitcoin_core import BitcoinCore
 from mempool_space import MempoolSpace
+from hedged_backend import HedgedBackend, HEDGE_PERCENTILE, MAX_FAILURES, COOLDOWN, TIMEOUT
+import output_index
 
+Config = configparser.ConfigParser()
+Config.read("rpc_config.ini")
 
-module = BitcoinCore()
+# "bitcoin_core" or the API URL of an esplora instance such as mempool.space
+def get_backend(name):
+    if name == "bitcoin_core":
+        return BitcoinCore()
+    return MempoolSpace(name)
 
-try:
-    module.getbestblockhash()
-    print("Using Bitcoin Core")
-except (requests.exceptions.ConnectionError, requests.exceptions.InvalidSchema):
-    module = MempoolSpace()
-    print("Using mempool.space")
+# A HedgedBackend over the sources under [BACKENDS] if there are any,
+# otherwise Bitcoin Core if it answers and mempool.space if it doesn't. The
+# choice is reported on stderr, as stdout may be carrying batch.py verdicts.
+def select_backend():
+    if Config.has_option("BACKENDS", "SOURCES"):
+        names = Config.get("BACKENDS", "SOURCES").replace(",", " ").split()
+        backend = HedgedBackend(
+            [(name, get_backend(name)) for name in names],
+            hedge_percentile=Config.getfloat("BACKENDS", "HEDGE_PERCENTILE", fallback=HEDGE_PERCENTILE),
+            max_failures=Config.getint("BACKENDS", "MAX_FAILURES", fallback=MAX_FAILURES),
+            cooldown=Config.getfloat("BACKENDS", "COOLDOWN", fallback=COOLDOWN),
+            timeout=Config.getfloat("BACKENDS", "TIMEOUT", fallback=TIMEOUT),
+        )
+        print(f"Using {', '.join(names)}", file=sys.stderr)
+        return backend
+
+    backend = BitcoinCore()
+    try:
+        backend.getbestblockhash()
+        print("Using Bitcoin Core", file=sys.stderr)
+    except (requests.exceptions.ConnectionError, requests.exceptions.InvalidSchema, requests.exceptions.Timeout):
+        backend = MempoolSpace()
+        print("Using mempool.space", file=sys.stderr)
+    return backend
+
+# Stands in for the selected backend and only selects it the first time one
+# of its methods is used, so importing this module (and everything that
+# imports it) doesn't touch the network. Offline tools such as
+# feature_store.py never use it.
+class LazyBackend:
+    def __init__(self):
+        self.backend = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        with self.lock:
+            if self.backend is None:
+                self.backend = select_backend()
+        return getattr(self.backend, method)
+
+module = LazyBackend()
 
 def get_confirmation_height(txid):
-    mempool_space = f"https://mempool.space/api/tx/{txid}/status"
-    response = requests.request("GET", mempool_space)
-    ret = json.loads(response.text)
-    if not ret["confirmed"]:
-        return -1
-    return ret["block_height"]
+    if output_index.active_index is not None:
+        height = output_index.active_index.get_tx_height(txid)
+        if height is not None:
+            return height
+
+    return module.getconfirmationheight(txid)
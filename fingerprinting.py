@@ -1,7 +1,9 @@
 from enum import Enum
 from tqdm.auto import tqdm
 
+import output_index
 from fetch_txs import module, get_confirmation_height
+from raw_tx import scan_inputs
 
 class InputSortingType(Enum):
     SINGLE = 0
@@ -30,6 +32,39 @@ class Wallets(Enum):
     UNCLEAR = "Unclear"
     OTHER = "Other"
 
+# Bitcoin Core and mempool.space name script types differently. Features are
+# stored with Bitcoin Core's names, in this order.
+SCRIPT_TYPES = [
+    "pubkey",
+    "pubkeyhash",
+    "scripthash",
+    "multisig",
+    "witness_v0_keyhash",
+    "witness_v0_scripthash",
+    "witness_v1_taproot",
+    "witness_unknown",
+    "anchor",
+    "nulldata",
+    "nonstandard",
+]
+
+MEMPOOL_SPACE_SCRIPT_TYPES = {
+    "p2pk": "pubkey",
+    "p2pkh": "pubkeyhash",
+    "p2sh": "scripthash",
+    "v0_p2wpkh": "witness_v0_keyhash",
+    "v0_p2wsh": "witness_v0_scripthash",
+    "v1_p2tr": "witness_v1_taproot",
+    "unknown": "witness_unknown",
+    "op_return": "nulldata",
+}
+
+def canonical_script_type(script_type):
+    script_type = MEMPOOL_SPACE_SCRIPT_TYPES.get(script_type, script_type)
+    if script_type not in SCRIPT_TYPES:
+        return "nonstandard"
+    return script_type
+
 def get_spending_types(tx):
     types = []
     for tx_in in tx["vin"]:
@@ -42,15 +77,13 @@ def get_sending_types(tx):
         types.append(tx_out["scriptpubkey_type"])
     return types
 
-def compressed_public_keys_only(tx):
-    input_types = get_spending_types(tx)
-    for i, input_type in enumerate(input_types):
-        if input_type == "witness_v0_keyhash" or input_type == "v0_p2wpkh":
-            if tx["vin"][i]["witness"][1][1] == '4':
-                return False
-        elif input_type == "pubkeyhash" or input_type == "p2pkh":
-            if tx["vin"][i]["scriptsig_asm"][tx["vin"][i]["scriptsig_asm"].find(" ") + 2] == '4':
-                return False
+# `scans` can be passed in to reuse the result of scan_inputs
+def compressed_public_keys_only(tx, scans=None):
+    if scans is None:
+        scans = scan_inputs(tx)
+    for scan in scans:
+        if False in scan.compressed:
+            return False
     return True
 
 def get_input_order(tx):
@@ -92,27 +125,13 @@ def get_input_order(tx):
     return sorting_types
 
 # Returns false if there is an r value of more than 32 bytes
-def low_r_only(tx):
-    input_types = get_spending_types(tx)
-    for i, input_type in enumerate(input_types):
-        if input_type == "witness_v0_keyhash":
-            r_len = tx["vin"][i]["witness"][0][6:8]
-            if int(r_len, 16) > 32:
-                return False
-        elif input_type == "pubkeyhash":
-            r_len = tx["vin"][i]["scriptsig_asm"][6:8]
-            if int(r_len, 16) > 32:
+def low_r_only(tx, scans=None):
+    if scans is None:
+        scans = scan_inputs(tx)
+    for scan in scans:
+        for r_len, sighash in scan.signatures:
+            if r_len is not None and r_len > 32:
                 return False
-        elif input_type == "p2pkh":
-            signature = tx["vin"][i]["scriptsig_asm"].split(' ')[1]
-            r_len = signature[6:8]
-            if int(r_len, 16) > 32:
-                return False
-        elif input_type == "v0_p2wpkh":
-            r_len = tx["vin"][i]["witness"][0][6:8]
-            if int(r_len, 16) > 32:
-                return False
-            
     return True
 
 def get_change_index(tx):
@@ -141,10 +160,23 @@ def get_change_index(tx):
     if len(shared_address) == 1 and output_script_pub_keys.count(shared_address[0]) == 1:
         return output_script_pub_keys.index(shared_address[0])
 
-    # TODO: Unnecessary Input Heuristic: https://en.bitcoin.it/wiki/Privacy#Change_address_detection
-    # input_amounts = [tx_out["value"] for tx_out in prev_txouts]
+    output_amounts = [round(tx_out["value"] * 100000000) for tx_out in vout] # stored as satoshis
+
+    # Unnecessary Input Heuristic: https://en.bitcoin.it/wiki/Privacy#Change_address_detection
+    # If an output could have been paid without the smallest input, a wallet
+    # wouldn't have picked it for that payment, so the output is likely change.
+    if len(vout) == 2 and len(prev_txouts) > 1:
+        input_amounts = [round(tx_out["value"] * 100000000) for tx_out in prev_txouts]
+        fee = sum(input_amounts) - sum(output_amounts)
+        without_smallest_input = sum(input_amounts) - min(input_amounts)
 
-    output_amounts = [int(tx_out["value"] * 100000000) for tx_out in vout] # stored as satoshis
+        possible_payments = []
+        for i, amount in enumerate(output_amounts):
+            if amount + fee > without_smallest_input:
+                possible_payments.append(i)
+
+        if len(possible_payments) == 1:
+            return 1 - possible_payments[0]
 
     possible_index = []
 
@@ -158,14 +190,36 @@ def get_change_index(tx):
     # else inconclusive, return -2
     return -2
 
+# How the outputs are ordered, which is all get_output_structure needs to know
+# about them besides the change index
+def get_output_order(tx):
+    amounts = []
+    outputs = []
+
+    for tx_out in tx["vout"]:
+        amounts.append(tx_out["value"])
+        outputs.append(tx_out["scriptpubkey"])
+
+    return {
+        "output_amounts_sorted": sorted(amounts) == amounts,
+        "output_amounts_distinct": len(set(amounts)) == len(amounts),
+        "output_scripts_sorted": sorted(outputs) == outputs,
+    }
+
 def get_output_structure(tx):
-    vout = tx["vout"]
-    if len(vout) == 1:
+    features = get_output_order(tx)
+    features["num_outputs"] = len(tx["vout"])
+    features["change_index"] = get_change_index(tx)
+    return get_output_structure_from_features(features)
+
+def get_output_structure_from_features(features):
+    num_outputs = features["num_outputs"]
+    if num_outputs == 1:
         return [OutputStructureType.SINGLE]
 
     output_structure = []
 
-    if len(vout) == 2:
+    if num_outputs == 2:
         output_structure.append(OutputStructureType.DOUBLE)
     else:
         output_structure.append(OutputStructureType.MULTI)
@@ -174,27 +228,19 @@ def get_output_structure(tx):
 
     # Change Index
 
-    change_index = get_change_index(tx)
-
-    if change_index == len(tx["vout"]) - 1:
+    if features["change_index"] == num_outputs - 1:
         output_structure.append(OutputStructureType.CHANGE_LAST)
 
     # BIP 69
-    amounts = []
-    outputs = []
-
-    for tx_out in vout:
-        amounts.append(tx_out["value"])
-        outputs.append(tx_out["scriptpubkey"])
 
     # There are duplicate amounts, so we also have to compare
     # by scriptPubKey
-    if len(set(amounts)) != len(amounts):
-        if sorted(outputs) == outputs and sorted(amounts) == amounts:
+    if not features["output_amounts_distinct"]:
+        if features["output_scripts_sorted"] and features["output_amounts_sorted"]:
             output_structure.append(OutputStructureType.BIP69)
             return output_structure
     else:
-        if sorted(amounts) == amounts:
+        if features["output_amounts_sorted"]:
             output_structure.append(OutputStructureType.BIP69)
             return output_structure
 
@@ -210,11 +256,19 @@ def has_multi_type_vin(tx):
 # 0 if possible
 # 1 if very likely
 # Note: also add if there isn't OP_CLTV in one of the inputs
-def is_anti_fee_sniping(tx):
+# mempool.space includes the confirmation status in the transaction, for
+# anything else ask the output index or the backend
+def get_tx_height(tx):
+    if "status" in tx:
+        return tx["status"].get("block_height", -1)
+    return get_confirmation_height(tx["txid"])
+
+def is_anti_fee_sniping(tx, tx_height=None):
     locktime = tx["locktime"]
     if locktime == 0:
         return -1
-    tx_height = get_confirmation_height(tx["txid"])
+    if tx_height is None:
+        tx_height = get_confirmation_height(tx["txid"])
     if tx_height - locktime >= 100:
         return 0
     return 1
@@ -253,17 +307,114 @@ def address_reuse(tx):
         return True
     return False
 
+# Uses the output index to check whether the change was sent to an address
+# that had already received coins before this transaction confirmed. Returns
+# None if there is no index or the transaction isn't in it.
+def change_address_reused(tx):
+    index = output_index.active_index
+    if index is None:
+        return None
+    tx_height = index.get_tx_height(tx["txid"])
+    if tx_height is None:
+        return None
+
+    change_index = get_change_index(tx)
+    if change_index < 0:
+        return False
+    first_seen = index.get_first_seen_height(tx["vout"][change_index]["scriptpubkey"])
+    return first_seen is not None and first_seen < tx_height
+
 def signals_rbf(tx):
     for tx_in in tx["vin"]:
         if tx_in["sequence"] < 0xffffffff:
             return True
     return False
 
-# need historical mempool data for this to be completely accurate
+# need historical mempool data for this to be completely accurate. Without it,
+# spending an output created in the same block is the best evidence we have,
+# which the output index can tell us. Returns None if there is no index or the
+# transaction isn't in it.
 def spends_unconfirmed(tx):
-    pass
+    index = output_index.active_index
+    if index is None:
+        return None
+    tx_height = index.get_tx_height(tx["txid"])
+    if tx_height is None:
+        return None
+
+    for tx_in in tx["vin"]:
+        prevout = index.get_outpoint(tx_in["txid"], tx_in["vout"])
+        if prevout is not None and prevout[0] >= tx_height:
+            return True
+    return False
+
+# Everything detect_wallet looks at, so that the rules can be re-run without
+# fetching the transaction (see feature_store.py)
+def get_features(tx):
+    locktime = tx["locktime"]
+    scans = scan_inputs(tx)
+    return {
+        "txid": tx["txid"],
+        "version": tx["version"],
+        "locktime": locktime,
+        "height": get_tx_height(tx),
+        "num_inputs": len(tx["vin"]),
+        "num_outputs": len(tx["vout"]),
+        "input_types": {canonical_script_type(t) for t in get_spending_types(tx)},
+        "output_types": {canonical_script_type(t) for t in get_sending_types(tx)},
+        "signals_rbf": signals_rbf(tx),
+        "low_r_only": low_r_only(tx, scans),
+        "compressed_public_keys_only": compressed_public_keys_only(tx, scans),
+        "address_reuse": address_reuse(tx),
+        "change_address_reused": change_address_reused(tx),
+        "spends_unconfirmed": spends_unconfirmed(tx),
+        "change_index": get_change_index(tx),
+        "change_type_matched_inputs": change_type_matched_inputs(tx),
+        "input_order": get_input_order(tx),
+        **get_output_order(tx),
+    }
+
+# Every reason detect_wallet_from_features can give, in the order it gives
+# them. Result tables store reasons as bits in this order, so new reasons
+# have to be added at the end.
+REASONS = [
+    "Anti-fee-sniping",
+    "No Anti-fee-sniping",
+    "Uncompressed public key(s)",
+    "All compressed public keys",
+    "nVersion = 1",
+    "nVersion = 2",
+    "non-standard nVersion number",
+    "Not low-r-grinding",
+    "Low r signatures only",
+    "signals RBF",
+    "does not signal RBF",
+    "Sends to taproot address",
+    "Creates OP_RETURN output",
+    "Spends taproot output",
+    "Spends P2PKH output",
+    "Has multi-type vin",
+    "Change type matched outputs",
+    "Change type matched inputs",
+    "Address reuse between vin and vout",
+    "Change sent to previously used address",
+    "No address reuse between vin and vout",
+    "More than 2 outputs",
+    "BIP-69 not followed by outputs",
+    "BIP-69 followed by outputs",
+    "BIP-69 not followed by inputs",
+    "BIP-69 followed by inputs",
+    "Inputs not ordered historically",
+    "Inputs ordered historically",
+    "Last index is not change",
+    "Last index is change",
+    "Spends output created in the same block",
+]
 
 def detect_wallet(tx):
+    return detect_wallet_from_features(get_features(tx))
+
+def detect_wallet_from_features(features):
     possible_wallets = {
         Wallets.BITCOIN_CORE,
         Wallets.ELECTRUM,
@@ -278,7 +429,7 @@ def detect_wallet(tx):
     reasoning = []
 
     # Anti-fee-sniping
-    if is_anti_fee_sniping(tx) != -1:
+    if is_anti_fee_sniping(features, features["height"]) != -1:
         reasoning.append("Anti-fee-sniping")
         # discard everything but Bitcoin Core and Electrum
         possible_wallets = {
@@ -291,20 +442,20 @@ def detect_wallet(tx):
         possible_wallets.discard(Wallets.ELECTRUM)
 
     # uncompressed public keys -> unknown
-    if not compressed_public_keys_only(tx):
+    if not features["compressed_public_keys_only"]:
         reasoning.append("Uncompressed public key(s)")
         possible_wallets = set()
     else:
         reasoning.append("All compressed public keys")
 
-    if tx["version"] == 1:
+    if features["version"] == 1:
         reasoning.append("nVersion = 1")
         possible_wallets.discard(Wallets.BITCOIN_CORE)
         possible_wallets.discard(Wallets.ELECTRUM)
         possible_wallets.discard(Wallets.BLUE_WALLET)
         possible_wallets.discard(Wallets.EXODUS)
         possible_wallets.discard(Wallets.COINBASE)
-    elif tx["version"] == 2:
+    elif features["version"] == 2:
         reasoning.append("nVersion = 2")
         possible_wallets.discard(Wallets.LEDGER)
         possible_wallets.discard(Wallets.TREZOR)
@@ -313,14 +464,14 @@ def detect_wallet(tx):
         reasoning.append("non-standard nVersion number")
         possible_wallets = set()
 
-    if not low_r_only(tx):
+    if not features["low_r_only"]:
         reasoning.append("Not low-r-grinding")
         possible_wallets.discard(Wallets.BITCOIN_CORE)
         possible_wallets.discard(Wallets.ELECTRUM)
     else:
         reasoning.append("Low r signatures only")
 
-    if signals_rbf(tx):
+    if features["signals_rbf"]:
         reasoning.append("signals RBF")
         possible_wallets.discard(Wallets.COINBASE)
         possible_wallets.discard(Wallets.EXODUS)
@@ -333,12 +484,12 @@ def detect_wallet(tx):
         possible_wallets.discard(Wallets.TREZOR)
         possible_wallets.discard(Wallets.TRUST)
         
-    sending_types = get_sending_types(tx)
-    if "witness_v1_taproot" in sending_types or "v1_p2tr" in sending_types:
+    sending_types = features["output_types"]
+    if "witness_v1_taproot" in sending_types:
         reasoning.append("Sends to taproot address")
         possible_wallets.discard(Wallets.COINBASE)
 
-    if "nulldata" in sending_types or "op_return" in sending_types:
+    if "nulldata" in sending_types:
         reasoning.append("Creates OP_RETURN output")
         possible_wallets.discard(Wallets.COINBASE)
         possible_wallets.discard(Wallets.EXODUS)
@@ -347,9 +498,9 @@ def detect_wallet(tx):
         possible_wallets.discard(Wallets.TRUST)
         possible_wallets.discard(Wallets.COINBASE)
 
-    spending_types = get_spending_types(tx)
+    spending_types = features["input_types"]
 
-    if "witness_v1_taproot" in spending_types or "v1_p2tr" in spending_types:
+    if "witness_v1_taproot" in spending_types:
         reasoning.append("Spends taproot output")
         possible_wallets.discard(Wallets.COINBASE)
         possible_wallets.discard(Wallets.EXODUS)
@@ -358,18 +509,18 @@ def detect_wallet(tx):
         possible_wallets.discard(Wallets.LEDGER)
         possible_wallets.discard(Wallets.TRUST)
 
-    if "witness_v0_scripthash" in spending_types or "v0_p2wsh" in spending_types:
+    if "witness_v0_scripthash" in spending_types:
         possible_wallets.discard(Wallets.COINBASE)
         possible_wallets.discard(Wallets.EXODUS)
         possible_wallets.discard(Wallets.TRUST)
         possible_wallets.discard(Wallets.TREZOR)
 
-    if "pubkeyhash" in spending_types or "p2pkh" in spending_types:
+    if "pubkeyhash" in spending_types:
         reasoning.append("Spends P2PKH output")
         possible_wallets.discard(Wallets.EXODUS)
         possible_wallets.discard(Wallets.TRUST)
 
-    if has_multi_type_vin(tx):
+    if len(spending_types) > 1:
         reasoning.append("Has multi-type vin")
         possible_wallets.discard(Wallets.EXODUS)
         possible_wallets.discard(Wallets.ELECTRUM)
@@ -378,7 +529,7 @@ def detect_wallet(tx):
         possible_wallets.discard(Wallets.TREZOR)
         possible_wallets.discard(Wallets.TRUST)
 
-    change_matched_inputs = change_type_matched_inputs(tx)
+    change_matched_inputs = features["change_type_matched_inputs"]
     if change_matched_inputs == -1:
         reasoning.append("Change type matched outputs")
         # change matched outputs
@@ -391,8 +542,14 @@ def detect_wallet(tx):
         reasoning.append("Change type matched inputs")
         possible_wallets.discard(Wallets.BITCOIN_CORE)
 
-    if address_reuse(tx):
+    reused = features["address_reuse"]
+    if reused:
         reasoning.append("Address reuse between vin and vout")
+    elif features["change_address_reused"]:
+        reasoning.append("Change sent to previously used address")
+        reused = True
+
+    if reused:
         possible_wallets.discard(Wallets.COINBASE)
         possible_wallets.discard(Wallets.BITCOIN_CORE)
         possible_wallets.discard(Wallets.ELECTRUM)
@@ -404,8 +561,8 @@ def detect_wallet(tx):
         possible_wallets.discard(Wallets.EXODUS)
         possible_wallets.discard(Wallets.TRUST)
 
-    input_order = get_input_order(tx)
-    output_structure = get_output_structure(tx)
+    input_order = features["input_order"]
+    output_structure = get_output_structure_from_features(features)
 
     if OutputStructureType.MULTI in output_structure:
         reasoning.append("More than 2 outputs")
@@ -435,9 +592,9 @@ def detect_wallet(tx):
         else:
             reasoning.append("Inputs ordered historically")
 
-    change_index = get_change_index(tx)
+    change_index = features["change_index"]
     if change_index >= 0:
-        if change_index != len(tx["vout"]) - 1:
+        if change_index != features["num_outputs"] - 1:
             reasoning.append("Last index is not change")
             possible_wallets.discard(Wallets.LEDGER)
             possible_wallets.discard(Wallets.BLUE_WALLET)
@@ -446,30 +603,39 @@ def detect_wallet(tx):
         else:
             reasoning.append("Last index is change")
 
+    if features["spends_unconfirmed"]:
+        reasoning.append("Spends output created in the same block")
+
     if len(possible_wallets) == 0:
         # calculate the rest of the fingerprints
         return {Wallets.OTHER}, reasoning
 
     return possible_wallets, reasoning
 
-def analyze_txs(transactions):
+def get_wallet_label(possible_wallets):
+    if len(possible_wallets) == 0:
+        return Wallets.OTHER
+    elif len(possible_wallets) == 1:
+        return list(possible_wallets)[0]
+    # This means that there are multiple possible wallets, and it is
+    # unclear which of them it is
+    return Wallets.UNCLEAR
+
+# If an output index is active and the block height is given, every
+# transaction is added to the index before it is classified
+def analyze_txs(transactions, height=None):
     wallets = {}
     for wallet_type in Wallets:
         wallets[wallet_type.value] =  {'total': 0, 'txs': []}
 
     for txid in tqdm(transactions):
-        wallet, reasoning = detect_wallet(module.get_tx(txid))
-        if len(wallet) == 0:
-            wallets[Wallets.OTHER.value]['total'] +=1
-            wallets[Wallets.OTHER.value]['txs'].append(txid)
-        elif len(wallet) == 1:
-            wallets[list(wallet)[0].value]['total'] +=1
-            wallets[list(wallet)[0].value]['txs'].append(txid)
-        else:
-            # This means that there are multiple possible wallets, and it is
-            # unclear which of them it is
-            wallets[Wallets.UNCLEAR.value]['total'] +=1
-            wallets[Wallets.UNCLEAR.value]['txs'].append(txid)
+        tx = module.get_tx(txid)
+        if output_index.active_index is not None and height is not None:
+            output_index.active_index.add_tx(tx, height)
+        wallet, reasoning = detect_wallet(tx)
+        label = get_wallet_label(wallet)
+        wallets[label.value]['total'] +=1
+        wallets[label.value]['txs'].append(txid)
 
     return wallets
 
@@ -488,7 +654,11 @@ def analyze_block(block_hash=None, num_of_txs=None, verbose=False):
     # exclude the coinbase transaction
     transactions = transactions[1:num_of_txs]
 
-    wallets = analyze_txs(transactions)
+    height = None
+    if output_index.active_index is not None:
+        height = module.getblockheight(block_hash)
+
+    wallets = analyze_txs(transactions, height)
     if (verbose):
         return wallets
 
@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Spreads requests over several backends (BitcoinCore / MempoolSpace
+# instances) listed in order of preference. Each request goes to the first
+# healthy source; if it hasn't answered within that source's usual latency
+# (the HEDGE_PERCENTILE of its recent requests of the same method), the same
+# request is also sent to the next source and whichever answers first is
+# used. A source that fails MAX_FAILURES times in a row is left out for
+# COOLDOWN seconds.
+
+HEDGE_PERCENTILE = 95
+# used until a source has enough latency samples
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_SAMPLES = 10
+MAX_FAILURES = 3
+COOLDOWN = 60
+TIMEOUT = 60
+
+class Source:
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        # method -> recent latencies. Methods cost very different amounts (a
+        # Bitcoin Core get_tx makes an RPC per input), so each has its own.
+        self.latencies = {}
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.disabled_until = 0
+
+    def is_available(self, now):
+        return now >= self.disabled_until
+
+    def add_latency(self, method, latency):
+        if method not in self.latencies:
+            self.latencies[method] = deque(maxlen=200)
+        self.latencies[method].append(latency)
+
+    # Over the samples for `method`, or for every method if it isn't given
+    def latency_percentile(self, percentile, method=None):
+        if method is None:
+            latencies = [latency for samples in self.latencies.values() for latency in samples]
+        else:
+            latencies = self.latencies.get(method, ())
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        latencies = sorted(latencies)
+        return latencies[int(percentile / 100 * (len(latencies) - 1))]
+
+# One request sent to one source
+class Attempt:
+    def __init__(self, source, method):
+        self.source = source
+        self.method = method
+        self.recorded = False
+
+class HedgedBackend:
+    def __init__(self, sources, hedge_percentile=HEDGE_PERCENTILE, max_failures=MAX_FAILURES,
+                 cooldown=COOLDOWN, timeout=TIMEOUT):
+        self.sources = [Source(name, backend) for name, backend in sources]
+        self.hedge_percentile = hedge_percentile
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=64)
+
+    # Any method of the underlying backends (get_tx, getblocktxs, ...) can be
+    # called on the composite
+    def __getattr__(self, method):
+        if method.startswith("_") or not any(hasattr(source.backend, method) for source in self.sources):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+    # Every attempt is counted once, either by the worker when the backend
+    # returns or by call() when it gives up waiting. A stalled request that
+    # finishes after the timeout is left out of the latencies and doesn't
+    # clear the source's failure streak.
+    def _record(self, attempt, latency=None):
+        source = attempt.source
+        with self.lock:
+            if attempt.recorded:
+                return
+            attempt.recorded = True
+            source.requests += 1
+            if latency is not None:
+                source.add_latency(attempt.method, latency)
+                source.consecutive_failures = 0
+                return
+            source.failures += 1
+            source.consecutive_failures += 1
+            if source.consecutive_failures >= self.max_failures:
+                source.disabled_until = time.monotonic() + self.cooldown
+
+    def _run(self, attempt, args):
+        start = time.monotonic()
+        try:
+            result = getattr(attempt.source.backend, attempt.method)(*args)
+        except Exception:
+            self._record(attempt)
+            raise
+        self._record(attempt, time.monotonic() - start)
+        return result
+
+    def hedge_delay(self, source, method):
+        delay = source.latency_percentile(self.hedge_percentile, method)
+        if delay is None:
+            return DEFAULT_HEDGE_DELAY
+        return delay
+
+    def call(self, method, *args):
+        candidates = [source for source in self.sources if hasattr(source.backend, method)]
+        now = time.monotonic()
+        # if every source has been taken out, try them all anyway
+        queue = [source for source in candidates if source.is_available(now)] or candidates
+
+        pending = {}
+        last_error = None
+        deadline = now + self.timeout
+
+        def launch():
+            source = queue.pop(0)
+            attempt = Attempt(source, method)
+            pending[self.executor.submit(self._run, attempt, args)] = attempt
+            return source
+
+        latest = launch()
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = min(self.hedge_delay(latest, method), remaining) if queue else remaining
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if queue:
+                    # too slow, send the same request to the next source
+                    latest = launch()
+                continue
+
+            for future in done:
+                del pending[future]
+                try:
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+
+            # everything we were waiting on failed, move on straight away
+            if not pending and queue:
+                latest = launch()
+
+        if not pending:
+            raise last_error
+        # still no answer, so count the stalled sources as failed
+        for attempt in pending.values():
+            self._record(attempt)
+        raise TimeoutError(f"no source answered {method} within {self.timeout} seconds")
+
+    def report(self):
+        now = time.monotonic()
+        report = {}
+        with self.lock:
+            for source in self.sources:
+                report[source.name] = {
+                    "healthy": source.is_available(now),
+                    "requests": source.requests,
+                    "failures": source.failures,
+                    "p50_latency": source.latency_percentile(50),
+                    f"p{self.hedge_percentile:g}_latency": source.latency_percentile(self.hedge_percentile),
+                    # the hedge delay used for each method
+                    "hedge_delays": {
+                        method: source.latency_percentile(self.hedge_percentile, method)
+                        for method in source.latencies
+                    },
+                }
+        return report
@@ -1,11 +1,20 @@
 import json
 import requests
 
+# seconds to wait for the server to connect and to send each part of a reply,
+# so a stalled request fails instead of holding on to a worker thread
+TIMEOUT = 30
+
 class MempoolSpace:
-    def __init__(self):
-        pass
+    # Any esplora instance can be used by passing its API URL
+    def __init__(self, url="https://mempool.space/api", timeout=TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
 
     def normalize_tx(self, tx):
+        # amounts are in BTC, as returned by Bitcoin Core
+        for tx_in in tx["vin"]:
+            tx_in["prevout"]["value"] = tx_in["prevout"]["value"] / 100000000
         for tx_out in tx["vout"]:
             tx_out["value"] = tx_out["value"] / 100000000
         return tx
@@ -14,38 +23,62 @@ class MempoolSpace:
         return self.normalize_tx(self.getdecodedtransaction(txid))
 
     def getbestblockhash(self):
-        URL = "https://mempool.space/api/blocks/tip/hash"
-        response = requests.request("GET", URL)
+        URL = f"{self.url}/blocks/tip/hash"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
 
         return response.text
 
     def getblocktxs(self, block_hash):
-        URL = f"https://mempool.space/api/block/{block_hash}/txids"
-        response = requests.request("GET", URL)
+        URL = f"{self.url}/block/{block_hash}/txids"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
 
         return json.loads(response.text)
 
+    def getblockheight(self, block_hash):
+        URL = f"{self.url}/block/{block_hash}"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
+
+        return json.loads(response.text)["height"]
+
+    # -1 if the transaction hasn't confirmed yet
+    def getconfirmationheight(self, txid):
+        URL = f"{self.url}/tx/{txid}/status"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
+        status = json.loads(response.text)
+
+        if not status["confirmed"]:
+            return -1
+        return status["block_height"]
+
     def getrawmempool(self):
-        URL = "https://mempool.space/api/mempool/txids"
-        response = requests.request("GET", URL)
+        URL = f"{self.url}/mempool/txids"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
 
         return response.text
 
     def getrawtransaction(self, txid):
-        URL = f"https://mempool.space/api/tx/{txid}/hex"
-        response = requests.request("GET", URL)
+        URL = f"{self.url}/tx/{txid}/hex"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
 
         return response.text
 
     def getdecodedtransaction(self, txid):
-        URL = f"https://mempool.space/api/tx/{txid}"
-        response = requests.request("GET", URL)
+        URL = f"{self.url}/tx/{txid}"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
 
         return json.loads(response.text)
 
     def getblocks(self, start_height):
-        URL = f"https://mempool.space/api/v1/blocks/{start_height}"
-        response = requests.request("GET", URL)
+        URL = f"{self.url}/v1/blocks/{start_height}"
+        response = requests.request("GET", URL, timeout=self.timeout)
+        response.raise_for_status()
         blocks = json.loads(response.text)
         
         return [block["id"] for block in blocks]
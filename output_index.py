@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+
+# A local index of the outputs seen while scanning blocks, so heuristics that
+# need to know about other transactions don't have to make a request per
+# input. It is kept in SQLite (no server, single file) in two tables:
+#
+#   outpoints: (txid, vout) -> creation height, value in sats, scriptPubKey
+#   scripts:   scriptPubKey -> height it was first seen at
+#
+# Rows are buffered and written in key order in a single transaction, which
+# keeps bulk loads close to sequential writes. Lookups check the buffers
+# before the database, so they don't force a write of their own.
+
+# The index used by the heuristics in fingerprinting.py, if any
+active_index = None
+
+def set_active_index(index):
+    global active_index
+    active_index = index
+
+class OutputIndex:
+    def __init__(self, path=":memory:", batch_size=100000):
+        self.batch_size = batch_size
+        # (txid, vout) -> (height, value, script)
+        self.pending_outpoints = {}
+        self.pending_scripts = {}
+        # batch.py classifies from several threads
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("PRAGMA mmap_size=1073741824")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS outpoints (
+                txid BLOB NOT NULL,
+                vout INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                script BLOB NOT NULL,
+                PRIMARY KEY (txid, vout)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS scripts (
+                script BLOB PRIMARY KEY,
+                first_height INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+    def add_tx(self, tx, height):
+        txid = bytes.fromhex(tx["txid"])
+        with self.lock:
+            for i, tx_out in enumerate(tx["vout"]):
+                script = bytes.fromhex(tx_out["scriptpubkey"])
+                value = round(tx_out["value"] * 100000000)
+                self.pending_outpoints[(txid, i)] = (height, value, script)
+                if height < self.pending_scripts.get(script, height + 1):
+                    self.pending_scripts[script] = height
+
+            if len(self.pending_outpoints) >= self.batch_size:
+                self.flush()
+
+    def add_block(self, txs, height):
+        for tx in txs:
+            self.add_tx(tx, height)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending_outpoints and not self.pending_scripts:
+                return
+
+            outpoints = sorted(key + row for key, row in self.pending_outpoints.items())
+            scripts = sorted(self.pending_scripts.items())
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO outpoints VALUES (?, ?, ?, ?, ?)",
+                    outpoints,
+                )
+                self.db.executemany(
+                    """INSERT INTO scripts VALUES (?, ?)
+                       ON CONFLICT (script) DO UPDATE SET first_height = MIN(first_height, excluded.first_height)""",
+                    scripts,
+                )
+            self.pending_outpoints = {}
+            self.pending_scripts = {}
+
+    # Drops everything indexed so far
+    def clear(self):
+        with self.lock:
+            self.pending_outpoints = {}
+            self.pending_scripts = {}
+            with self.db:
+                self.db.execute("DELETE FROM outpoints")
+                self.db.execute("DELETE FROM scripts")
+
+    # Returns (height, value in sats, scriptPubKey hex), or None if the
+    # outpoint hasn't been indexed
+    def get_outpoint(self, txid, vout):
+        key = (bytes.fromhex(txid), vout)
+        with self.lock:
+            row = self.pending_outpoints.get(key)
+            if row is None:
+                row = self.db.execute(
+                    "SELECT height, value, script FROM outpoints WHERE txid = ? AND vout = ?",
+                    key,
+                ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2].hex()
+
+    # Every output of a transaction is indexed at the same height, so the
+    # first one is enough to find where it confirmed
+    def get_tx_height(self, txid):
+        outpoint = self.get_outpoint(txid, 0)
+        if outpoint is None:
+            return None
+        return outpoint[0]
+
+    def get_first_seen_height(self, scriptpubkey):
+        script = bytes.fromhex(scriptpubkey)
+        with self.lock:
+            pending = self.pending_scripts.get(script)
+            row = self.db.execute(
+                "SELECT first_height FROM scripts WHERE script = ?",
+                (script,),
+            ).fetchone()
+        if row is None:
+            return pending
+        if pending is None:
+            return row[0]
+        return min(row[0], pending)
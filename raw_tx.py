@@ -0,0 +1,370 @@
+import hashlib
+
+# Minimal reader for serialized transactions, used where we are handed raw
+# hex instead of a txid and need to work out what to look up.
+
+class TxReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, n):
+        if self.pos + n > len(self.data):
+            raise ValueError("unexpected end of transaction data")
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def read_uint(self, n):
+        return int.from_bytes(self.read(n), "little")
+
+    def read_varint(self):
+        prefix = self.read_uint(1)
+        if prefix == 0xfd:
+            return self.read_uint(2)
+        if prefix == 0xfe:
+            return self.read_uint(4)
+        if prefix == 0xff:
+            return self.read_uint(8)
+        return prefix
+
+    def read_varbytes(self):
+        return self.read(self.read_varint())
+
+def is_txid(line):
+    if len(line) != 64:
+        return False
+    try:
+        bytes.fromhex(line)
+    except ValueError:
+        return False
+    return True
+
+# Returns the serialization without marker, flag and witnesses, which is what
+# the txid commits to
+def strip_witness(raw):
+    reader = TxReader(raw)
+    version = reader.read(4)
+    segwit = raw[4:6] == b"\x00\x01"
+    if segwit:
+        reader.read(2)
+
+    start = reader.pos
+    num_inputs = reader.read_varint()
+    for _ in range(num_inputs):
+        reader.read(36)
+        reader.read_varbytes()
+        reader.read(4)
+    num_outputs = reader.read_varint()
+    for _ in range(num_outputs):
+        reader.read(8)
+        reader.read_varbytes()
+    end = reader.pos
+
+    if segwit:
+        for _ in range(num_inputs):
+            for _ in range(reader.read_varint()):
+                reader.read_varbytes()
+    locktime = reader.read(4)
+
+    if reader.pos != len(raw):
+        raise ValueError("trailing data after transaction")
+
+    return version + raw[start:end] + locktime
+
+def txid_from_raw(tx_hex):
+    stripped = strip_witness(bytes.fromhex(tx_hex))
+    return hashlib.sha256(hashlib.sha256(stripped).digest()).digest()[::-1].hex()
+
+# Bitcoin Core's name for the type of an output script
+def get_script_type(script):
+    size = len(script)
+    if size == 25 and script[:3] == b"\x76\xa9\x14" and script[23:] == b"\x88\xac":
+        return "pubkeyhash"
+    if is_p2sh_output(script):
+        return "scripthash"
+    if is_p2wpkh_output(script):
+        return "witness_v0_keyhash"
+    if is_p2wsh_output(script):
+        return "witness_v0_scripthash"
+    if is_taproot_output(script):
+        return "witness_v1_taproot"
+    if script == b"\x51\x02\x4e\x73":
+        return "anchor"
+    if size >= 4 and (script[0] == 0x00 or 0x51 <= script[0] <= 0x60) and script[1] == size - 2 and 2 <= script[1] <= 40:
+        return "witness_unknown"
+    if size and script[0] == 0x6a:
+        return "nulldata"
+    if (size == 35 or size == 67) and script[0] == size - 2 and script[-1] == 0xac:
+        return "pubkey"
+    if size >= 37 and script[-1] == 0xae and 0x51 <= script[0] <= 0x60 and 0x51 <= script[-2] <= 0x60:
+        keys = list(iter_pushes(script[1:-2]))
+        if len(keys) == script[-2] - 0x50 and all(get_pubkey_compression(key) is not None for key in keys):
+            return "multisig"
+    return "nonstandard"
+
+# Decodes a serialized transaction into the format returned by get_tx,
+# without the prevouts of its inputs
+def decode_raw_tx(tx_hex):
+    raw = bytes.fromhex(tx_hex)
+    reader = TxReader(raw)
+    version = reader.read_uint(4)
+    segwit = raw[4:6] == b"\x00\x01"
+    if segwit:
+        reader.read(2)
+
+    vin = []
+    for _ in range(reader.read_varint()):
+        vin.append({
+            "txid": reader.read(32)[::-1].hex(),
+            "vout": reader.read_uint(4),
+            "scriptsig": reader.read_varbytes().hex(),
+            "sequence": reader.read_uint(4),
+        })
+    vout = []
+    for _ in range(reader.read_varint()):
+        value = reader.read_uint(8)
+        script = reader.read_varbytes()
+        vout.append({
+            "scriptpubkey": script.hex(),
+            "scriptpubkey_type": get_script_type(script),
+            # in BTC, as returned by both backends
+            "value": value / 100000000,
+        })
+    if segwit:
+        for tx_in in vin:
+            tx_in["witness"] = [reader.read_varbytes().hex() for _ in range(reader.read_varint())]
+    locktime = reader.read_uint(4)
+
+    if reader.pos != len(raw):
+        raise ValueError("trailing data after transaction")
+
+    return {
+        "txid": txid_from_raw(tx_hex),
+        "version": version,
+        "locktime": locktime,
+        "vin": vin,
+        "vout": vout,
+    }
+
+COINBASE_TXID = "00" * 32
+
+# Decodes a serialized transaction and looks up only the transactions it
+# spends from, with `get_raw_tx` (txid -> raw hex) such as
+# module.getrawtransaction. The transaction itself doesn't have to be known
+# to the backend.
+def tx_from_raw(tx_hex, get_raw_tx):
+    tx = decode_raw_tx(tx_hex)
+    parents = {}
+    for tx_in in tx["vin"]:
+        txid = tx_in["txid"]
+        if txid == COINBASE_TXID:
+            raise ValueError("coinbase transactions have no prevouts to look up")
+        if txid not in parents:
+            parents[txid] = decode_raw_tx(get_raw_tx(txid))
+        tx_in["prevout"] = parents[txid]["vout"][tx_in["vout"]]
+    return tx
+
+# Byte-level scanning of the signatures and public keys in an input's
+# scriptSig and witness. This works the same way for every input type:
+# every pushed item is looked at, and P2SH redeem scripts and P2WSH witness
+# scripts are scanned for the public keys they contain.
+
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+TAPROOT_ANNEX_TAG = 0x50
+SIGHASH_DEFAULT = 0x00
+
+# Yields the data pushed by a script, skipping any other opcodes. Stops at a
+# push that runs past the end of the script, as a malformed or truncated
+# script can't be parsed any further.
+def iter_pushes(script):
+    i = 0
+    end = len(script)
+    while i < end:
+        opcode = script[i]
+        i += 1
+        if 0 < opcode < OP_PUSHDATA1:
+            size = opcode
+        elif OP_PUSHDATA1 <= opcode <= OP_PUSHDATA4:
+            # the length is 1, 2 or 4 bytes
+            length_size = 1 << (opcode - OP_PUSHDATA1)
+            if i + length_size > end:
+                return
+            size = int.from_bytes(script[i:i + length_size], "little")
+            i += length_size
+        else:
+            continue
+        if i + size > end:
+            return
+        yield script[i:i + size]
+        i += size
+
+# Returns (length of r, sighash type) for a DER encoded ECDSA signature
+# followed by its sighash byte, or None if it isn't one
+def parse_der_signature(item):
+    # 0x30 len 0x02 r_len r 0x02 s_len s sighash
+    if len(item) < 9 or item[0] != 0x30 or item[1] != len(item) - 3 or item[2] != 0x02:
+        return None
+    r_len = item[3]
+    if 5 + r_len >= len(item) or item[4 + r_len] != 0x02:
+        return None
+    s_len = item[5 + r_len]
+    if 6 + r_len + s_len != len(item) - 1:
+        return None
+    return r_len, item[-1]
+
+# Returns True for a compressed public key, False for an uncompressed (or
+# hybrid) one and None if the item isn't a public key
+def get_pubkey_compression(item):
+    if len(item) == 33 and item[0] in (0x02, 0x03):
+        return True
+    if len(item) == 65 and item[0] in (0x04, 0x06, 0x07):
+        return False
+    return None
+
+def is_taproot_output(scriptpubkey):
+    return len(scriptpubkey) == 34 and scriptpubkey[0] == 0x51 and scriptpubkey[1] == 0x20
+
+def is_p2wsh_output(scriptpubkey):
+    return len(scriptpubkey) == 34 and scriptpubkey[0] == 0x00 and scriptpubkey[1] == 0x20
+
+def is_p2wpkh_output(scriptpubkey):
+    return len(scriptpubkey) == 22 and scriptpubkey[0] == 0x00 and scriptpubkey[1] == 0x14
+
+def is_p2sh_output(scriptpubkey):
+    return len(scriptpubkey) == 23 and scriptpubkey[0] == 0xa9 and scriptpubkey[1] == 0x14 and scriptpubkey[22] == 0x87
+
+class InputScan:
+    __slots__ = ("signatures", "compressed")
+
+    def __init__(self, signatures=None, compressed=None):
+        # (length of r, sighash type) per signature, r is None for schnorr
+        self.signatures = [] if signatures is None else signatures
+        # True/False per public key found
+        self.compressed = [] if compressed is None else compressed
+
+    def add_item(self, item):
+        # only DER signatures start with 0x30 and only public keys are 33 or
+        # 65 bytes long, so most items need a single check
+        if item[:1] == b"\x30":
+            signature = parse_der_signature(item)
+            if signature is not None:
+                self.signatures.append(signature)
+                return
+        if len(item) == 33 or len(item) == 65:
+            compressed = get_pubkey_compression(item)
+            if compressed is not None:
+                self.compressed.append(compressed)
+
+    def add_script(self, script):
+        for item in iter_pushes(script):
+            compressed = get_pubkey_compression(item)
+            if compressed is not None:
+                self.compressed.append(compressed)
+
+def scan_taproot_witness(scan, witness):
+    if len(witness) >= 2 and witness[-1][:1] == bytes([TAPROOT_ANNEX_TAG]):
+        witness = witness[:-1]
+
+    if len(witness) == 1:
+        # key path spend
+        items = witness
+    else:
+        # script path spend: the control block and the script come last, and
+        # public keys in tapscripts are always x-only
+        items = witness[:-2]
+
+    for item in items:
+        if len(item) == 64:
+            scan.signatures.append((None, SIGHASH_DEFAULT))
+        elif len(item) == 65:
+            scan.signatures.append((None, item[64]))
+
+# Fast path for the common single key inputs (P2WPKH and P2PKH), which hold
+# exactly one signature and one public key. Only the outer DER header of the
+# signature is checked (BIP-66 made strict DER encoding a consensus rule) and
+# the length of r and the sighash byte are read straight from the hex. Inputs
+# that scan the same share one InputScan, as there are only a few hundred
+# possible results, so the scans returned must not be modified. Returns None
+# if the input doesn't have the expected shape, so that the general scan
+# handles it.
+BYTE_HEX = [f"{i:02x}" for i in range(256)]
+single_key_scans = {}
+
+def scan_single_key(signature, pubkey):
+    prefix = pubkey[:2]
+    if len(pubkey) == 66 and (prefix == "02" or prefix == "03"):
+        compressed = True
+    elif len(pubkey) == 130 and (prefix == "04" or prefix == "06" or prefix == "07"):
+        compressed = False
+    else:
+        return None
+
+    # 0x30 len 0x02 r_len ... sighash
+    size = len(signature) >> 1
+    if size < 9 or size > 258 or signature[:2] != "30" or signature[2:4] != BYTE_HEX[size - 3] or signature[4:6] != "02":
+        return None
+
+    key = (signature[6:8], signature[-2:], compressed)
+    scan = single_key_scans.get(key)
+    if scan is None:
+        scan = InputScan([(int(key[0], 16), int(key[1], 16))], [compressed])
+        single_key_scans[key] = scan
+    return scan
+
+def scan_input(tx_in):
+    scriptpubkey_hex = tx_in["prevout"]["scriptpubkey"]
+    if len(scriptpubkey_hex) == 44 and scriptpubkey_hex[:4] == "0014":
+        # P2WPKH: <signature> <public key> in the witness
+        witness = tx_in.get("witness")
+        if witness and len(witness) == 2 and not tx_in.get("scriptsig"):
+            scan = scan_single_key(witness[0], witness[1])
+            if scan is not None:
+                return scan
+    elif len(scriptpubkey_hex) == 50 and scriptpubkey_hex[:6] == "76a914" and scriptpubkey_hex[46:] == "88ac":
+        # P2PKH: <signature> <public key> pushed by the scriptSig, both
+        # shorter than OP_PUSHDATA1
+        scriptsig = tx_in.get("scriptsig", "")
+        end = 2 + 2 * int(scriptsig[:2] or "0", 16)
+        if scriptsig[:2] < "4c" and end + 2 < len(scriptsig) and 2 * int(scriptsig[end:end + 2], 16) == len(scriptsig) - end - 2:
+            scan = scan_single_key(scriptsig[2:end], scriptsig[end + 2:])
+            if scan is not None:
+                return scan
+
+    scan = InputScan()
+    scriptpubkey = bytes.fromhex(scriptpubkey_hex)
+    scriptsig = tx_in.get("scriptsig")
+    pushes = list(iter_pushes(bytes.fromhex(scriptsig))) if scriptsig else []
+    witness = [bytes.fromhex(item) for item in tx_in.get("witness", ())]
+
+    if pushes and is_p2sh_output(scriptpubkey):
+        # the redeem script is pushed last, and is either a script of its own
+        # or a nested segwit program
+        redeem_script = pushes.pop()
+        if is_p2wsh_output(redeem_script) or is_p2wpkh_output(redeem_script):
+            scriptpubkey = redeem_script
+        else:
+            scan.add_script(redeem_script)
+
+    if is_taproot_output(scriptpubkey):
+        scan_taproot_witness(scan, witness)
+        return scan
+
+    if is_p2wsh_output(scriptpubkey) and witness:
+        # the witness script is the last item of the witness
+        scan.add_script(witness[-1])
+        witness = witness[:-1]
+    elif not is_p2wpkh_output(scriptpubkey) and not is_p2sh_output(scriptpubkey):
+        # bare scripts (P2PK, multisig) hold their public keys in the output
+        scan.add_script(scriptpubkey)
+
+    for item in pushes:
+        scan.add_item(item)
+    for item in witness:
+        scan.add_item(item)
+    return scan
+
+def scan_inputs(tx):
+    return [scan_input(tx_in) for tx_in in tx["vin"]]
@@ -0,0 +1,169 @@
+import json
+import os
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from fetch_txs import module
+from fingerprinting import REASONS, Wallets, detect_wallet, get_tx_height
+
+# Columnar storage for classification results. Instead of a Python list of
+# hex txids per wallet, every transaction is one row across a few contiguous
+# arrays:
+#
+#   txids    (n, 32) uint8   binary txid, in the usual (display) byte order
+#   wallets  (n,)    uint16  bitmask of candidate wallets, bit i = WALLETS[i]
+#   heights  (n,)    int32   confirmation height, -1 if unknown
+#   reasons  (n,)    uint64  bitmask over REASONS, in the order of that list
+#
+# A table is saved as a directory holding one .npy file per column plus a
+# small meta.json, so it can be memory-mapped back without parsing anything.
+
+WALLETS = list(Wallets)
+WALLET_BITS = {wallet: 1 << i for i, wallet in enumerate(WALLETS)}
+
+MAX_REASONS = 64
+
+# Same bucketing as get_wallet_label, precomputed for every possible mask
+def _build_label_table():
+    table = np.empty(1 << len(WALLETS), dtype=np.uint8)
+    for mask in range(len(table)):
+        bits = [i for i in range(len(WALLETS)) if mask & (1 << i)]
+        if len(bits) == 0:
+            table[mask] = WALLETS.index(Wallets.OTHER)
+        elif len(bits) == 1:
+            table[mask] = bits[0]
+        else:
+            table[mask] = WALLETS.index(Wallets.UNCLEAR)
+    return table
+
+LABEL_TABLE = _build_label_table()
+
+COLUMNS = {
+    "txids": (np.uint8, (32,)),
+    "wallets": (np.uint16, ()),
+    "heights": (np.int32, ()),
+    "reasons": (np.uint64, ()),
+}
+
+class ResultTable:
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.reasons = list(REASONS)
+        self.columns = {
+            name: np.zeros((capacity,) + shape, dtype=dtype)
+            for name, (dtype, shape) in COLUMNS.items()
+        }
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        capacity = max(1024, 2 * len(self.columns["wallets"]))
+        for name, (dtype, shape) in COLUMNS.items():
+            column = np.zeros((capacity,) + shape, dtype=dtype)
+            column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+
+    def _reason_bit(self, reason):
+        try:
+            return 1 << self.reasons.index(reason)
+        except ValueError:
+            pass
+        # only rules that aren't in REASONS yet get here, e.g. a detect
+        # function passed to feature_store.replay
+        if len(self.reasons) == MAX_REASONS:
+            raise ValueError(f"more than {MAX_REASONS} distinct reasons")
+        self.reasons.append(reason)
+        return 1 << (len(self.reasons) - 1)
+
+    def append(self, txid, possible_wallets, reasoning, height=-1):
+        if self.size == len(self.columns["wallets"]):
+            self._grow()
+
+        wallet_mask = 0
+        for wallet in possible_wallets:
+            wallet_mask |= WALLET_BITS[wallet]
+        reason_mask = 0
+        for reason in reasoning:
+            reason_mask |= self._reason_bit(reason)
+
+        i = self.size
+        self.columns["txids"][i] = np.frombuffer(bytes.fromhex(txid), dtype=np.uint8)
+        self.columns["wallets"][i] = wallet_mask
+        self.columns["heights"][i] = height
+        self.columns["reasons"][i] = reason_mask
+        self.size += 1
+
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    def txid(self, i):
+        return self.column("txids")[i].tobytes().hex()
+
+    def candidates(self, i):
+        mask = int(self.column("wallets")[i])
+        return {wallet for wallet in WALLETS if mask & WALLET_BITS[wallet]}
+
+    def reasoning(self, i):
+        mask = int(self.column("reasons")[i])
+        return [reason for bit, reason in enumerate(self.reasons) if mask & (1 << bit)]
+
+    def labels(self):
+        return LABEL_TABLE[self.column("wallets")]
+
+    def totals(self):
+        counts = np.bincount(self.labels(), minlength=len(WALLETS))
+        return {wallet.value: int(counts[i]) for i, wallet in enumerate(WALLETS)}
+
+    def txids_for(self, wallet):
+        rows = np.flatnonzero(self.labels() == WALLETS.index(wallet))
+        return [self.txid(i) for i in rows]
+
+    # Same shape as the result of analyze_txs
+    def to_dict(self):
+        totals = self.totals()
+        return {
+            wallet.value: {'total': totals[wallet.value], 'txs': self.txids_for(wallet)}
+            for wallet in WALLETS
+        }
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(path, f"{name}.npy"), self.column(name))
+        meta = {
+            "wallets": [wallet.value for wallet in WALLETS],
+            "reasons": self.reasons,
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["wallets"] != [wallet.value for wallet in WALLETS]:
+            raise ValueError("result table was written with a different set of wallets")
+
+        # meta.json lists the reasons the table was written with. New ones
+        # go at the end of REASONS, so older tables keep their meaning.
+        common = min(len(meta["reasons"]), len(REASONS))
+        if meta["reasons"][:common] != REASONS[:common]:
+            raise ValueError("result table was written with a different set of reasons")
+
+        table = cls(capacity=0)
+        table.reasons = meta["reasons"] if len(meta["reasons"]) > len(REASONS) else list(REASONS)
+        mmap_mode = "r" if mmap else None
+        for name in COLUMNS:
+            table.columns[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+        table.size = len(table.columns["wallets"])
+        return table
+
+def analyze_txs_columnar(transactions):
+    table = ResultTable()
+    for txid in tqdm(transactions):
+        tx = module.get_tx(txid)
+        wallet, reasoning = detect_wallet(tx)
+        table.append(txid, wallet, reasoning, get_tx_height(tx))
+    return table
@@ -0,0 +1,408 @@
+import random
+
+from fingerprinting import Wallets
+from output_index import OutputIndex
+
+# Generates normalized transactions (in the same format as get_tx) with the
+# fingerprints of a chosen wallet, so classification can be load tested and
+# checked against a known label without any network access.
+#
+# Heuristics that need to look up other transactions (confirmation heights
+# for anti-fee-sniping and historical input order) are answered from an
+# OutputIndex that every generated transaction and its parents are added to.
+# Activate it with output_index.set_active_index(chain.index) before
+# classifying. The index holds every output added to it (a few hundred bytes
+# each), so iter_transactions clears it at the start of each block, while
+# generate_block keeps everything for SyntheticBackend.
+#
+# Each wallet profile describes:
+#   version            nVersion
+#   anti_fee_sniping   locktime set close to the current height (else 0)
+#   rbf                inputs signal RBF
+#   low_r              only low-r signatures (else half of them are high-r)
+#   input_types        {script type: weight}, one type per transaction
+#   mixed_inputs       pick the type per input instead
+#   output_types       {script type: weight} for payment outputs
+#   max_inputs, max_outputs
+#   input_order        "random", "bip69" or "historical"
+#   output_order       "random", "bip69" or "change_last"
+#   change_type        "inputs" or "outputs": the type the change matches
+#   address_reuse      change goes back to the first input's address
+#   op_return          probability of adding an OP_RETURN output
+
+SEGWIT_TYPES = {"witness_v0_keyhash": 3, "witness_v1_taproot": 1}
+
+WALLET_PROFILES = {
+    Wallets.BITCOIN_CORE: {
+        "version": 2,
+        "anti_fee_sniping": True,
+        "rbf": True,
+        "low_r": True,
+        "input_types": {"witness_v0_keyhash": 3, "witness_v1_taproot": 1, "pubkeyhash": 1},
+        "mixed_inputs": True,
+        "output_types": {"witness_v0_keyhash": 3, "witness_v1_taproot": 1, "scripthash": 1},
+        "max_inputs": 4,
+        "max_outputs": 4,
+        "input_order": "random",
+        "output_order": "random",
+        "change_type": "outputs",
+        "address_reuse": False,
+        "op_return": 0.05,
+    },
+    Wallets.ELECTRUM: {
+        "version": 2,
+        "anti_fee_sniping": True,
+        "rbf": True,
+        "low_r": True,
+        "input_types": {"witness_v0_keyhash": 1},
+        "mixed_inputs": False,
+        "output_types": {"witness_v0_keyhash": 1, "scripthash": 1, "pubkeyhash": 1},
+        "max_inputs": 4,
+        "max_outputs": 3,
+        "input_order": "bip69",
+        "output_order": "bip69",
+        "change_type": "inputs",
+        "address_reuse": False,
+        "op_return": 0,
+    },
+    Wallets.BLUE_WALLET: {
+        "version": 2,
+        "anti_fee_sniping": False,
+        "rbf": True,
+        "low_r": False,
+        "input_types": {"witness_v0_keyhash": 3, "scripthash": 1},
+        "mixed_inputs": False,
+        "output_types": SEGWIT_TYPES,
+        "max_inputs": 3,
+        "max_outputs": 3,
+        "input_order": "random",
+        "output_order": "change_last",
+        "change_type": "inputs",
+        "address_reuse": False,
+        "op_return": 0,
+    },
+    Wallets.COINBASE: {
+        "version": 2,
+        "anti_fee_sniping": False,
+        "rbf": False,
+        "low_r": False,
+        "input_types": {"witness_v0_keyhash": 3, "pubkeyhash": 1},
+        "mixed_inputs": False,
+        "output_types": {"witness_v0_keyhash": 3, "scripthash": 1},
+        "max_inputs": 3,
+        "max_outputs": 2,
+        "input_order": "random",
+        "output_order": "change_last",
+        "change_type": "inputs",
+        "address_reuse": False,
+        "op_return": 0,
+    },
+    Wallets.EXODUS: {
+        "version": 2,
+        "anti_fee_sniping": False,
+        "rbf": False,
+        "low_r": False,
+        "input_types": {"witness_v0_keyhash": 1},
+        "mixed_inputs": False,
+        "output_types": SEGWIT_TYPES,
+        "max_inputs": 3,
+        "max_outputs": 2,
+        "input_order": "random",
+        "output_order": "random",
+        "change_type": "inputs",
+        "address_reuse": True,
+        "op_return": 0,
+    },
+    Wallets.TRUST: {
+        "version": 1,
+        "anti_fee_sniping": False,
+        "rbf": True,
+        "low_r": False,
+        "input_types": {"witness_v0_keyhash": 1},
+        "mixed_inputs": False,
+        "output_types": SEGWIT_TYPES,
+        "max_inputs": 3,
+        "max_outputs": 2,
+        "input_order": "random",
+        "output_order": "random",
+        "change_type": "inputs",
+        "address_reuse": True,
+        "op_return": 0,
+    },
+    Wallets.TREZOR: {
+        "version": 1,
+        "anti_fee_sniping": False,
+        "rbf": True,
+        "low_r": False,
+        "input_types": {"witness_v0_keyhash": 3, "witness_v1_taproot": 1},
+        "mixed_inputs": False,
+        "output_types": SEGWIT_TYPES,
+        "max_inputs": 3,
+        "max_outputs": 2,
+        "input_order": "bip69",
+        "output_order": "bip69",
+        "change_type": "inputs",
+        "address_reuse": False,
+        "op_return": 0,
+    },
+    Wallets.LEDGER: {
+        "version": 1,
+        "anti_fee_sniping": False,
+        "rbf": True,
+        "low_r": False,
+        "input_types": {"witness_v0_keyhash": 3, "pubkeyhash": 1},
+        "mixed_inputs": False,
+        "output_types": SEGWIT_TYPES,
+        "max_inputs": 3,
+        "max_outputs": 2,
+        "input_order": "historical",
+        "output_order": "change_last",
+        "change_type": "inputs",
+        "address_reuse": False,
+        "op_return": 0,
+    },
+}
+
+def push(data_hex):
+    return f"{len(data_hex) // 2:02x}{data_hex}"
+
+class SyntheticChain:
+    def __init__(self, mix=None, profiles=None, seed=0, start_height=800000, index=None):
+        self.profiles = profiles if profiles is not None else WALLET_PROFILES
+        # {wallet: weight}, every profile equally likely by default
+        mix = mix if mix is not None else {wallet: 1 for wallet in self.profiles}
+        self.wallets = list(mix.keys())
+        self.weights = list(mix.values())
+        self.rng = random.Random(seed)
+        self.height = start_height
+        self.index = index if index is not None else OutputIndex()
+
+    def random_hex(self, num_bytes):
+        return f"{self.rng.getrandbits(8 * num_bytes):0{2 * num_bytes}x}"
+
+    def choose(self, weights):
+        return self.rng.choices(list(weights.keys()), list(weights.values()))[0]
+
+    def make_scriptpubkey(self, script_type):
+        if script_type == "pubkeyhash":
+            return "76a914" + self.random_hex(20) + "88ac"
+        if script_type == "scripthash":
+            return "a914" + self.random_hex(20) + "87"
+        if script_type == "witness_v0_keyhash":
+            return "0014" + self.random_hex(20)
+        if script_type == "witness_v0_scripthash":
+            return "0020" + self.random_hex(32)
+        if script_type == "witness_v1_taproot":
+            return "5120" + self.random_hex(32)
+        raise ValueError(f"can't generate {script_type} outputs")
+
+    def make_signature(self, low_r):
+        if low_r or self.rng.random() < 0.5:
+            r = f"{self.rng.randrange(0x80):02x}" + self.random_hex(31)
+        else:
+            # a high r value needs a padding byte to stay positive
+            r = "00" + f"{self.rng.randrange(0x80, 0x100):02x}" + self.random_hex(31)
+        s = f"{self.rng.randrange(0x80):02x}" + self.random_hex(31)
+        body = f"02{len(r) // 2:02x}{r}02{len(s) // 2:02x}{s}"
+        return f"30{len(body) // 2:02x}{body}01"
+
+    def make_input(self, script_type, value, low_r, sequence):
+        pubkey = self.rng.choice(("02", "03")) + self.random_hex(32)
+        tx_in = {
+            "txid": self.random_hex(32),
+            "vout": 0,
+            "scriptsig": "",
+            "scriptsig_asm": "",
+            "sequence": sequence,
+            "prevout": {
+                "scriptpubkey": self.make_scriptpubkey(script_type),
+                "scriptpubkey_type": script_type,
+                "value": value / 100000000,
+            },
+        }
+        if script_type == "pubkeyhash":
+            tx_in["scriptsig"] = push(self.make_signature(low_r)) + push(pubkey)
+        elif script_type == "scripthash":
+            # P2SH-wrapped P2WPKH
+            tx_in["scriptsig"] = push("0014" + self.random_hex(20))
+            tx_in["witness"] = [self.make_signature(low_r), pubkey]
+        elif script_type == "witness_v0_keyhash":
+            tx_in["witness"] = [self.make_signature(low_r), pubkey]
+        elif script_type == "witness_v1_taproot":
+            tx_in["witness"] = [self.random_hex(64)]
+        else:
+            raise ValueError(f"can't generate {script_type} inputs")
+        return tx_in
+
+    # Splits `total` into `count` values that are each larger than `minimum`
+    def split_amount(self, total, count, minimum):
+        remainder = total - count * (minimum + 1)
+        cuts = sorted(self.rng.randrange(remainder + 1) for _ in range(count - 1))
+        bounds = [0] + cuts + [remainder]
+        return [minimum + 1 + bounds[i + 1] - bounds[i] for i in range(count)]
+
+    def generate_tx(self, wallet, height):
+        profile = self.profiles[wallet]
+        rng = self.rng
+
+        num_inputs = rng.randint(1, profile["max_inputs"])
+        num_payments = rng.randint(1, profile["max_outputs"] - 1)
+
+        # payments are round amounts and the change isn't. Every input is
+        # larger than the change, so none of them were unnecessary.
+        payments = [rng.randrange(100, 100000) * 1000 for _ in range(num_payments)]
+        fee = rng.randrange(500, 5000)
+        change = rng.randrange(1000, max(1001, min(50000, payments[0] // (2 * num_inputs))))
+        if change % 100 == 0:
+            change += 1
+        input_values = self.split_amount(sum(payments) + fee + change, num_inputs, change)
+
+        if profile["mixed_inputs"]:
+            input_types = [self.choose(profile["input_types"]) for _ in range(num_inputs)]
+        else:
+            input_types = [self.choose(profile["input_types"])] * num_inputs
+
+        if profile["rbf"]:
+            sequence = 0xfffffffd
+        elif profile["anti_fee_sniping"]:
+            sequence = 0xfffffffe
+        else:
+            sequence = 0xffffffff
+
+        vin = [
+            self.make_input(input_type, value, profile["low_r"], sequence)
+            for input_type, value in zip(input_types, input_values)
+        ]
+
+        # payments of the same type as the inputs would look like change
+        payment_types = [self.choose(profile["output_types"]) for _ in payments]
+        other_types = [t for t in profile["output_types"] if t not in input_types]
+        if other_types:
+            payment_types = [t if t not in input_types else rng.choice(other_types) for t in payment_types]
+
+        if profile["change_type"] == "inputs":
+            change_type = input_types[0]
+        else:
+            change_type = payment_types[0]
+
+        vout = [
+            {"scriptpubkey": self.make_scriptpubkey(t), "scriptpubkey_type": t, "value": amount / 100000000}
+            for t, amount in zip(payment_types, payments)
+        ]
+        if profile["address_reuse"]:
+            change_output = {
+                "scriptpubkey": vin[0]["prevout"]["scriptpubkey"],
+                "scriptpubkey_type": change_type,
+                "value": change / 100000000,
+            }
+        else:
+            change_output = {
+                "scriptpubkey": self.make_scriptpubkey(change_type),
+                "scriptpubkey_type": change_type,
+                "value": change / 100000000,
+            }
+
+        if profile["output_order"] == "bip69":
+            vout.append(change_output)
+            vout.sort(key=lambda tx_out: (tx_out["value"], tx_out["scriptpubkey"]))
+        elif profile["output_order"] == "change_last":
+            vout.append(change_output)
+        else:
+            vout.insert(rng.randint(0, len(vout)), change_output)
+            # avoid looking like BIP-69 by accident
+            amounts = [tx_out["value"] for tx_out in vout]
+            if sorted(amounts) == amounts:
+                vout.reverse()
+
+        if rng.random() < profile["op_return"]:
+            vout.append({"scriptpubkey": "6a" + push(self.random_hex(20)), "scriptpubkey_type": "nulldata", "value": 0})
+
+        parent_heights = [rng.randrange(height - 50000, height) for _ in vin]
+        if profile["input_order"] == "bip69":
+            vin.sort(key=lambda tx_in: f"{tx_in['txid']}:{tx_in['vout']}")
+        elif profile["input_order"] == "historical":
+            parent_heights.sort()
+        elif len(vin) > 1 and parent_heights == sorted(parent_heights):
+            parent_heights.reverse()
+
+        if profile["anti_fee_sniping"]:
+            locktime = height - 1 - rng.randrange(3)
+        else:
+            locktime = 0
+
+        tx = {
+            "txid": self.random_hex(32),
+            "version": profile["version"],
+            "locktime": locktime,
+            "vin": vin,
+            "vout": vout,
+            "status": {"confirmed": True, "block_height": height},
+        }
+
+        for tx_in, parent_height in zip(vin, parent_heights):
+            self.index.add_tx({"txid": tx_in["txid"], "vout": [tx_in["prevout"]]}, parent_height)
+        self.index.add_tx(tx, height)
+        return tx
+
+    # Returns a list of (transaction, wallet that made it)
+    def generate_block(self, num_txs):
+        height = self.height
+        self.height += 1
+        block = []
+        for wallet in self.rng.choices(self.wallets, self.weights, k=num_txs):
+            block.append((self.generate_tx(wallet, height), wallet))
+        self.index.flush()
+        return block
+
+    # Yields (transaction, wallet) for `num_txs` transactions spread over
+    # blocks of `block_size`, without keeping them around. Generated
+    # transactions never spend each other, so with `prune` the index only
+    # holds the current block and memory use doesn't grow with `num_txs`.
+    # Each transaction has to be classified before the next block starts.
+    def iter_transactions(self, num_txs, block_size=3000, prune=True):
+        while num_txs > 0:
+            if prune:
+                self.index.clear()
+            height = self.height
+            self.height += 1
+            for wallet in self.rng.choices(self.wallets, self.weights, k=min(block_size, num_txs)):
+                yield self.generate_tx(wallet, height), wallet
+            num_txs -= block_size
+
+# Serves generated blocks through the same interface as BitcoinCore and
+# MempoolSpace, so analyze_block can run on them by setting
+# fingerprinting.module to an instance of this.
+class SyntheticBackend:
+    def __init__(self, chain):
+        self.chain = chain
+        self.txs = {}
+        self.blocks = {}
+        self.heights = {}
+        self.best_block_hash = None
+
+    def add_block(self, num_txs):
+        block_hash = self.chain.random_hex(32)
+        self.heights[block_hash] = self.chain.height
+        block = self.chain.generate_block(num_txs)
+        for tx, wallet in block:
+            self.txs[tx["txid"]] = tx
+        # analyze_block skips the first transaction, which is the coinbase
+        self.blocks[block_hash] = ["00" * 32] + [tx["txid"] for tx, wallet in block]
+        self.best_block_hash = block_hash
+        return block_hash, block
+
+    def get_tx(self, txid):
+        return self.txs[txid]
+
+    def getbestblockhash(self):
+        return self.best_block_hash
+
+    def getblocktxs(self, block_hash):
+        return self.blocks[block_hash]
+
+    def getblockheight(self, block_hash):
+        return self.heights[block_hash]
+
+    def getconfirmationheight(self, txid):
+        height = self.chain.index.get_tx_height(txid)
+        return -1 if height is None else height
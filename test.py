@@ -1,7 +1,54 @@
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from unittest import mock
 
+import fetch_txs
+from bitcoin_core import BitcoinCore
 from fetch_txs import module
+import fingerprinting
 from fingerprinting import *
+from batch import classify_stream
+from raw_tx import is_txid, txid_from_raw, scan_input, parse_der_signature, iter_pushes, get_script_type, tx_from_raw
+from output_index import OutputIndex, set_active_index
+import clustering
+from clustering import CHUNK_SIZE, WalletClusters, cluster_verdicts
+from hedged_backend import DEFAULT_HEDGE_DELAY, HedgedBackend
+from synthetic import SyntheticBackend, SyntheticChain
+from feature_store import FeatureWriter, load_features, iter_features, replay, to_record
+from results import ResultTable, WALLETS, get_tx_height
+
+GENESIS_COINBASE_TXID = "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b"
+GENESIS_COINBASE_HEX = "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000"
+
+# A single input, single output P2WPKH transaction with no locktime, so that
+# detect_wallet doesn't need to look anything up
+def make_offline_tx(txid="11" * 32):
+    return {
+        "txid": txid,
+        "version": 2,
+        "locktime": 0,
+        "vin": [{
+            "txid": "22" * 32,
+            "vout": 0,
+            "sequence": 0xfffffffd,
+            "scriptsig": "",
+            "scriptsig_asm": "",
+            "witness": ["3044022011" + "00" * 31 + "022022" + "00" * 31 + "01", "02" + "33" * 32],
+            "prevout": {"scriptpubkey": "0014" + "44" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 0.00020000},
+        }],
+        "vout": [
+            {"scriptpubkey": "0014" + "55" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 0.00019000},
+        ],
+        "status": {"confirmed": False},
+    }
 
 class TestFingerprinting(unittest.TestCase):
     def test_spending_types(self):
@@ -47,8 +94,7 @@ class TestFingerprinting(unittest.TestCase):
         assert get_change_index(module.get_tx("43f901163b8c27567d365f56bb804bd74904bd78d58017905f3c36cac971d9b6")) == 1
         assert get_change_index(module.get_tx("Bd4a846c05c37029caf7f6cef453112eef362ca511bd6a52f9082d85b7b2f207")) == -1
         assert get_change_index(module.get_tx("d63aadc93aca05be5561d76888edf61e7f772b96fb1e43231111fe5fbcc4a601")) == -2
-        # should be 1 after unnecessary input heuristic is implemented
-        assert get_change_index(module.get_tx("60849af6e56c2ad0facd601cc5014398210898a7e6d5b9280b54f6395349663a")) == -2
+        assert get_change_index(module.get_tx("60849af6e56c2ad0facd601cc5014398210898a7e6d5b9280b54f6395349663a")) == 1
 
     def test_get_output_structure(self):
         tx = module.get_tx("bc8c701594207360a409d64a9c797a46dd11a2d468948e8bb98e865249ca17e3")
@@ -137,5 +183,651 @@ class TestFingerprinting(unittest.TestCase):
         wallet, reasoning = detect_wallet(module.get_tx("047b1779fceb28852d890fd36bbc0481ed7aa8eb8b73fc1ab19d7707780c041d"))
         assert wallet == {Wallets.LEDGER}
 
+class TestOutputIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = OutputIndex(batch_size=2)
+        set_active_index(self.index)
+
+    def tearDown(self):
+        set_active_index(None)
+        self.index.close()
+
+    def test_lookups(self):
+        parent = make_offline_tx("aa" * 32)
+        parent["vout"].append({"scriptpubkey": "0014" + "66" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 1.5})
+        self.index.add_block([parent], 100)
+        self.index.add_tx(make_offline_tx("bb" * 32), 90)
+
+        assert self.index.get_outpoint("aa" * 32, 1) == (100, 150000000, "0014" + "66" * 20)
+        assert self.index.get_outpoint("aa" * 32, 2) is None
+        assert self.index.get_tx_height("bb" * 32) == 90
+        assert get_confirmation_height("aa" * 32) == 100
+        # both transactions pay to the same script, the lower height wins
+        assert self.index.get_first_seen_height("0014" + "55" * 20) == 90
+
+    def test_tx_height(self):
+        # Bitcoin Core doesn't include a confirmation status
+        tx = make_offline_tx("aa" * 32)
+        del tx["status"]
+        self.index.add_tx(tx, 100)
+        assert get_tx_height(tx) == 100
+        assert get_tx_height(make_offline_tx("bb" * 32)) == -1
+
+    def test_lookups_dont_flush(self):
+        index = OutputIndex(batch_size=1000)
+        index.add_block([make_offline_tx("aa" * 32)], 100)
+        index.add_tx(make_offline_tx("bb" * 32), 90)
+
+        assert index.get_tx_height("aa" * 32) == 100
+        assert index.get_tx_height("bb" * 32) == 90
+        assert index.get_first_seen_height("0014" + "55" * 20) == 90
+        # the second transaction is still waiting for the next batch
+        assert len(index.pending_outpoints) == 1
+        assert index.db.execute("SELECT COUNT(*) FROM outpoints").fetchone()[0] == 1
+        index.close()
+
+    def test_spends_unconfirmed(self):
+        child = make_offline_tx("cc" * 32)
+        child["vin"][0]["txid"] = "aa" * 32
+        assert spends_unconfirmed(child) is None
+
+        self.index.add_tx(make_offline_tx("aa" * 32), 100)
+        self.index.add_tx(child, 100)
+        assert spends_unconfirmed(child)
+
+        child["vin"][0]["txid"] = "dd" * 32
+        assert not spends_unconfirmed(child)
+
+    def test_change_address_reused(self):
+        tx = make_offline_tx("cc" * 32)
+        tx["vout"].append({"scriptpubkey": "0014" + "77" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 0.00000123})
+        assert change_address_reused(tx) is None
+
+        self.index.add_tx(tx, 100)
+        assert get_change_index(tx) == 1
+        assert not change_address_reused(tx)
+
+        self.index.add_tx(make_offline_tx("dd" * 32) | {"vout": [tx["vout"][1]]}, 50)
+        assert change_address_reused(tx)
+
+class TestUnnecessaryInput(unittest.TestCase):
+    def test_get_change_index(self):
+        tx = make_offline_tx()
+        tx["vin"].append(dict(tx["vin"][0], vout=1))
+        tx["vin"][0]["prevout"] = dict(tx["vin"][0]["prevout"], value=0.00050000)
+        tx["vin"][1]["prevout"] = dict(tx["vin"][1]["prevout"], value=0.00010000)
+        tx["vout"] = [
+            {"scriptpubkey": "0014" + "55" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 0.00052000},
+            {"scriptpubkey": "0014" + "66" * 20, "scriptpubkey_type": "v0_p2wpkh", "value": 0.00007000},
+        ]
+        assert get_change_index(tx) == 1
+
+        # either output could have been paid by the larger input alone
+        tx["vout"][0]["value"] = 0.00045000
+        tx["vout"][1]["value"] = 0.00014000
+        assert get_change_index(tx) == -2
+
+class TestClustering(unittest.TestCase):
+    def test_union_find(self):
+        clusters = WalletClusters()
+        for i in range(6):
+            clusters.add(f"{i:064x}", {Wallets.OTHER}, [])
+        clusters.union(0, 1)
+        clusters.union(2, 3)
+        clusters.union(1, 3)
+        assert clusters.find(0) == clusters.find(2)
+        assert clusters.find(4) != clusters.find(5)
+        assert len(set(clusters.roots())) == 3
+        assert list(clusters.roots()) == [clusters.find(i) for i in range(6)]
+
+    def test_resolves_unclear(self):
+        clusters = WalletClusters()
+        # spends from the same script as the next transaction
+        clusters.add("aa" * 32, {Wallets.BITCOIN_CORE, Wallets.ELECTRUM}, [("11" * 32, 0, "0014" + "11" * 20)], change_index=1)
+        clusters.add("bb" * 32, {Wallets.ELECTRUM, Wallets.TREZOR}, [("22" * 32, 0, "0014" + "11" * 20)])
+        # spends the change of the first transaction
+        clusters.add("cc" * 32, {Wallets.ELECTRUM, Wallets.BLUE_WALLET}, [("AA" * 32, 1, "0014" + "33" * 20)])
+        # unrelated
+        clusters.add("dd" * 32, {Wallets.LEDGER, Wallets.TREZOR}, [("44" * 32, 0, "0014" + "44" * 20)])
+        clusters.add("ee" * 32, {Wallets.OTHER}, [("55" * 32, 0, "0014" + "44" * 20)])
+
+        before, after = clusters.labels()
+        assert [WALLETS[label] for label in after] == [Wallets.ELECTRUM] * 3 + [Wallets.OTHER] * 2
+
+        report = clusters.report()
+        assert report["clusters"] == 2
+        assert report["unclear"] == 4
+        assert report["resolved"] == 3
+        assert report["conflicting"] == 1
+
+    def test_change_across_chunks(self):
+        clustering.CHUNK_SIZE = 1
+        try:
+            clusters = WalletClusters()
+            clusters.add("aa" * 32, {Wallets.OTHER}, [("11" * 32, 0, "0014" + "11" * 20)], change_index=1)
+            clusters.add("bb" * 32, {Wallets.OTHER}, [("22" * 32, 0, "0014" + "22" * 20)])
+            clusters.add("cc" * 32, {Wallets.OTHER}, [("aa" * 32, 1, "0014" + "33" * 20)])
+        finally:
+            clustering.CHUNK_SIZE = CHUNK_SIZE
+        roots = clusters.roots()
+        assert roots[0] == roots[2] != roots[1]
+        assert len(clusters.change_outputs) == 1
+
+    def test_chunked_inputs(self):
+        # inputs are matched against earlier scripts a chunk at a time, which
+        # must give the same clusters as matching them one by one
+        rng = random.Random(0)
+        clustering.CHUNK_SIZE = 7
+        try:
+            clusters = WalletClusters()
+            expected = WalletClusters()
+            first_spender = {}
+            for node in range(300):
+                scripts = [f"{rng.randrange(200):04x}" for _ in range(rng.randint(1, 3))]
+                clusters.add(f"{node:064x}", {Wallets.OTHER}, [("aa" * 32, 0, script) for script in scripts])
+                expected.add(f"{node:064x}", {Wallets.OTHER}, [])
+                for script in scripts:
+                    expected.union(node, first_spender.setdefault(script, node))
+        finally:
+            clustering.CHUNK_SIZE = CHUNK_SIZE
+
+        roots = clusters.roots()
+        expected_roots = expected.roots()
+        assert len(clusters.input_scripts.runs) > 1
+        for a in range(0, 300, 7):
+            for b in range(300):
+                assert (roots[a] == roots[b]) == (expected_roots[a] == expected_roots[b])
+
+    def test_cluster_verdicts(self):
+        out = io.StringIO()
+        totals = classify_stream(iter(["aa" * 32, "bb" * 32]), out, get_tx=make_offline_tx)
+        out.write(json.dumps({"totals": totals}) + "\n")
+
+        # both transactions spend the same outpoint in the fixture
+        clusters = cluster_verdicts(io.StringIO(out.getvalue()))
+        assert len(clusters) == 2
+        assert clusters.report()["clusters"] == 1
+
+class TestFeatureStore(unittest.TestCase):
+    def test_import_is_offline(self):
+        # the backend is only picked (and probed) once it is used
+        code = "import fetch_txs, feature_store; assert fetch_txs.module.backend is None"
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_replay(self):
+        txs = [make_offline_tx("aa" * 32), make_offline_tx("bb" * 32)]
+        txs[1]["version"] = 1
+        txs[1]["vout"].append({"scriptpubkey": "6a00", "scriptpubkey_type": "op_return", "value": 0})
+        txs[0]["status"] = {"confirmed": True, "block_height": 100}
+
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "features")
+            with FeatureWriter(path) as writer:
+                for tx in txs:
+                    writer.write(get_features(tx))
+
+            records = load_features(path)
+            assert len(records) == 2
+            replayed = list(iter_features(records))
+            assert replayed[0] == get_features(txs[0])
+            assert replayed[1]["output_types"] == {"witness_v0_keyhash", "nulldata"}
+            assert replayed[1]["spends_unconfirmed"] is None
+            # heights are stored even without a locktime, and the output
+            # structure is worked out again from the stored order
+            assert replayed[0]["height"] == 100
+            for tx, features in zip(txs, replayed):
+                assert get_output_structure_from_features(features) == get_output_structure(tx)
+
+            table = replay(path)
+            for i, tx in enumerate(txs):
+                wallet, reasoning = detect_wallet(tx)
+                assert table.txid(i) == tx["txid"]
+                assert table.candidates(i) == wallet
+                assert table.reasoning(i) == reasoning
+            assert list(table.column("heights")) == [100, -1]
+
+    def test_batch_features(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "features")
+            with FeatureWriter(path) as writer:
+                classify_stream(iter(["aa" * 32, "not a transaction"]), io.StringIO(), get_tx=make_offline_tx, features=writer)
+            assert replay(path).txid(0) == "aa" * 32
+
+    def test_unsigned_version(self):
+        tx = make_offline_tx()
+        tx["version"] = 0xffffffff
+        features = get_features(tx)
+        assert next(iter_features(to_record(features).reshape(1)))["version"] == 0xffffffff
+        tx["version"] = -1
+        assert next(iter_features(to_record(get_features(tx)).reshape(1)))["version"] == 0xffffffff
+
+    def test_bad_record(self):
+        class BrokenWriter:
+            def write(self, features):
+                raise OverflowError("out of bounds")
+
+        out = io.StringIO()
+        totals = classify_stream(iter(["aa" * 32, "bb" * 32]), out, get_tx=make_offline_tx, features=BrokenWriter())
+        verdicts = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert len(verdicts) == 2 and all("error" in verdict for verdict in verdicts)
+        assert totals["Error"] == 2
+
+class FakeBackend:
+    def __init__(self, name, delay=0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def get_tx(self, txid):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(self.name)
+        return {"txid": txid, "source": self.name}
+
+    def getconfirmationheight(self, txid):
+        self.get_tx(txid)
+        return 100
+
+class TestBitcoinCore(unittest.TestCase):
+    def test_confirmation_height_error(self):
+        reply = json.dumps({"result": None, "error": {"code": -5, "message": "No such mempool or blockchain transaction"}})
+        with mock.patch("bitcoin_core.requests.request", return_value=mock.Mock(text=reply)):
+            with self.assertRaisesRegex(RuntimeError, "No such mempool"):
+                BitcoinCore().getconfirmationheight("aa" * 32)
+
+        reply = json.dumps({"result": {"txid": "aa" * 32}, "error": None})
+        with mock.patch("bitcoin_core.requests.request", return_value=mock.Mock(text=reply)):
+            assert BitcoinCore().getconfirmationheight("aa" * 32) == -1
+
+class TestHedgedBackend(unittest.TestCase):
+    def test_hedges_slow_source(self):
+        slow = FakeBackend("slow", delay=0.5)
+        fast = FakeBackend("fast")
+        backend = HedgedBackend([("slow", slow), ("fast", fast)])
+        for source in backend.sources:
+            for _ in range(20):
+                source.add_latency("get_tx", 0.01)
+
+        assert backend.get_tx("aa" * 32)["source"] == "fast"
+        assert slow.calls == 1 and fast.calls == 1
+
+    def test_latency_per_method(self):
+        backend = HedgedBackend([("a", FakeBackend("a")), ("b", FakeBackend("b"))])
+        source = backend.sources[0]
+        for _ in range(20):
+            source.add_latency("get_tx", 2.0)
+            source.add_latency("getconfirmationheight", 0.01)
+        assert backend.hedge_delay(source, "get_tx") == 2.0
+        assert backend.hedge_delay(source, "getconfirmationheight") == 0.01
+        assert backend.hedge_delay(source, "getblocktxs") == DEFAULT_HEDGE_DELAY
+        assert backend.report()["a"]["hedge_delays"] == {"get_tx": 2.0, "getconfirmationheight": 0.01}
+
+    def test_prefers_first_source(self):
+        first = FakeBackend("first")
+        second = FakeBackend("second")
+        backend = HedgedBackend([("first", first), ("second", second)])
+        assert backend.get_tx("aa" * 32)["source"] == "first"
+        assert second.calls == 0
+
+    def test_failover(self):
+        broken = FakeBackend("broken", fail=True)
+        working = FakeBackend("working")
+        backend = HedgedBackend([("broken", broken), ("working", working)], max_failures=2)
+
+        for _ in range(4):
+            assert backend.get_tx("aa" * 32)["source"] == "working"
+        # taken out of rotation after two failures in a row
+        assert broken.calls == 2
+
+        report = backend.report()
+        assert not report["broken"]["healthy"]
+        assert report["broken"]["failures"] == 2
+        assert report["working"]["requests"] == 4
+
+    def test_all_sources_fail(self):
+        backend = HedgedBackend([("a", FakeBackend("a", fail=True)), ("b", FakeBackend("b", fail=True))])
+        with self.assertRaises(ConnectionError):
+            backend.get_tx("aa" * 32)
+        with self.assertRaises(AttributeError):
+            backend.getblocktxs
+
+    def test_confirmation_height(self):
+        working = FakeBackend("working")
+        fetch_txs.module = HedgedBackend([("broken", FakeBackend("broken", fail=True)), ("working", working)])
+        try:
+            assert get_confirmation_height("aa" * 32) == 100
+        finally:
+            fetch_txs.module = module
+        assert working.calls == 1
+
+    def test_timeout(self):
+        backend = HedgedBackend([("stalled", FakeBackend("stalled", delay=0.3))], timeout=0.05)
+        with self.assertRaises(TimeoutError):
+            backend.get_tx("aa" * 32)
+        assert backend.report()["stalled"]["failures"] == 1
+
+        # the late answer must not be counted a second time
+        time.sleep(0.4)
+        report = backend.report()["stalled"]
+        assert report["requests"] == 1 and report["failures"] == 1
+        assert backend.sources[0].consecutive_failures == 1
+        assert backend.sources[0].latencies == {}
+
+def make_der_signature(r_len=32, sighash=0x01):
+    r = "01" * r_len
+    s = "02" * 32
+    body = f"02{r_len:02x}{r}0220{s}"
+    return f"30{len(body) // 2:02x}{body}{sighash:02x}"
+
+def push(item):
+    return f"{len(item) // 2:02x}{item}"
+
+COMPRESSED_PUBKEY = "02" + "33" * 32
+UNCOMPRESSED_PUBKEY = "04" + "44" * 64
+
+class TestSignatureScan(unittest.TestCase):
+    def test_parse_der_signature(self):
+        assert parse_der_signature(bytes.fromhex(make_der_signature())) == (32, 0x01)
+        assert parse_der_signature(bytes.fromhex(make_der_signature(33, 0x83))) == (33, 0x83)
+        assert parse_der_signature(bytes.fromhex(COMPRESSED_PUBKEY)) is None
+        assert parse_der_signature(bytes.fromhex(make_der_signature())[:-2]) is None
+
+    def test_iter_pushes(self):
+        script = bytes.fromhex("00" + push("aa" * 3) + "4c02bbbb" + "ae")
+        assert list(iter_pushes(script)) == [bytes.fromhex("aaaaaa"), bytes.fromhex("bbbb")]
+        assert list(iter_pushes(bytes.fromhex("4d0100aa" + "4e"))) == [bytes.fromhex("aa")]
+
+        # pushes that run past the end of the script
+        assert list(iter_pushes(bytes.fromhex(push("aa") + "4c"))) == [bytes.fromhex("aa")]
+        assert list(iter_pushes(bytes.fromhex("4d01"))) == []
+        assert list(iter_pushes(bytes.fromhex("05aaaa"))) == []
+        scan = scan_input({"scriptsig": "", "prevout": {"scriptpubkey": "514c"}})
+        assert scan.signatures == [] and scan.compressed == []
+
+    def test_p2pkh(self):
+        tx_in = {
+            "scriptsig": push(make_der_signature(33)) + push(UNCOMPRESSED_PUBKEY),
+            "prevout": {"scriptpubkey": "76a914" + "11" * 20 + "88ac"},
+        }
+        scan = scan_input(tx_in)
+        assert scan.signatures == [(33, 0x01)]
+        assert scan.compressed == [False]
+
+    def test_single_key_fast_path(self):
+        tx_in = {
+            "scriptsig": "",
+            "witness": [make_der_signature(33, 0x83), UNCOMPRESSED_PUBKEY],
+            "prevout": {"scriptpubkey": "0014" + "11" * 20},
+        }
+        scan = scan_input(tx_in)
+        assert scan.signatures == [(33, 0x83)]
+        assert scan.compressed == [False]
+
+        # anything else falls through to the general scan
+        tx_in["witness"] = ["30" + "00" * 8, COMPRESSED_PUBKEY]
+        scan = scan_input(tx_in)
+        assert scan.signatures == []
+        assert scan.compressed == [True]
+
+    def test_p2sh_p2wpkh(self):
+        tx_in = {
+            "scriptsig": push("0014" + "11" * 20),
+            "witness": [make_der_signature(), COMPRESSED_PUBKEY],
+            "prevout": {"scriptpubkey": "a914" + "22" * 20 + "87"},
+        }
+        scan = scan_input(tx_in)
+        assert scan.signatures == [(32, 0x01)]
+        assert scan.compressed == [True]
+
+    def test_p2wsh_multisig(self):
+        witness_script = "52" + push(COMPRESSED_PUBKEY) + push(UNCOMPRESSED_PUBKEY) + "52ae"
+        tx_in = {
+            "scriptsig": "",
+            "witness": ["", make_der_signature(), make_der_signature(33, 0x02), witness_script],
+            "prevout": {"scriptpubkey": "0020" + "33" * 32},
+        }
+        scan = scan_input(tx_in)
+        assert scan.signatures == [(32, 0x01), (33, 0x02)]
+        assert scan.compressed == [True, False]
+
+        tx = {"vin": [tx_in]}
+        assert not low_r_only(tx)
+        assert not compressed_public_keys_only(tx)
+
+    def test_legacy_p2sh_multisig(self):
+        redeem_script = "51" + push(UNCOMPRESSED_PUBKEY) + "51ae"
+        tx_in = {
+            "scriptsig": "00" + push(make_der_signature()) + "4c" + push(redeem_script),
+            "prevout": {"scriptpubkey": "a914" + "22" * 20 + "87"},
+        }
+        scan = scan_input(tx_in)
+        assert scan.signatures == [(32, 0x01)]
+        assert scan.compressed == [False]
+
+    def test_taproot(self):
+        key_path = {
+            "scriptsig": "",
+            "witness": ["55" * 64],
+            "prevout": {"scriptpubkey": "5120" + "66" * 32},
+        }
+        assert scan_input(key_path).signatures == [(None, 0x00)]
+
+        script_path = dict(key_path, witness=["55" * 64 + "83", "20" + "77" * 32 + "ac", "c0" + "88" * 32])
+        scan = scan_input(script_path)
+        assert scan.signatures == [(None, 0x83)]
+        assert scan.compressed == []
+
+class TestSynthetic(unittest.TestCase):
+    def setUp(self):
+        self.chain = SyntheticChain(seed=0)
+        set_active_index(self.chain.index)
+
+    def tearDown(self):
+        set_active_index(None)
+        self.chain.index.close()
+
+    def test_ground_truth(self):
+        for tx, wallet in self.chain.iter_transactions(400, block_size=100):
+            assert get_wallet_label(detect_wallet(tx)[0]) == wallet
+
+    def test_prune(self):
+        for i, (tx, wallet) in enumerate(self.chain.iter_transactions(30, block_size=10)):
+            if i == 20:
+                first_of_last_block = tx["txid"]
+        index = self.chain.index
+        index.flush()
+        assert index.get_tx_height(first_of_last_block) is not None
+        # only the outputs of the last block and its parents are left
+        num_outputs = index.db.execute("SELECT COUNT(*) FROM outpoints").fetchone()[0]
+        assert num_outputs <= 10 * (8 + 8 + 1)
+
+    def test_mix(self):
+        chain = SyntheticChain(mix={Wallets.LEDGER: 1}, seed=1)
+        block = chain.generate_block(20)
+        assert {wallet for tx, wallet in block} == {Wallets.LEDGER}
+        assert all(tx["version"] == 1 for tx, wallet in block)
+        chain.index.close()
+
+    def test_analyze_block(self):
+        backend = SyntheticBackend(self.chain)
+        block_hash, block = backend.add_block(50)
+
+        fingerprinting.module = backend
+        try:
+            totals = analyze_block(block_hash)
+        finally:
+            fingerprinting.module = module
+
+        for wallet_type in Wallets:
+            assert totals[wallet_type.value] == sum(1 for tx, wallet in block if wallet == wallet_type)
+
+def serialize_tx(tx):
+    def le(n, size):
+        return n.to_bytes(size, "little").hex()
+
+    def var(item):
+        return f"{len(item) // 2:02x}{item}"
+
+    segwit = any(tx_in.get("witness") for tx_in in tx["vin"])
+    raw = le(tx["version"], 4) + ("0001" if segwit else "") + f"{len(tx['vin']):02x}"
+    for tx_in in tx["vin"]:
+        raw += bytes.fromhex(tx_in["txid"])[::-1].hex() + le(tx_in["vout"], 4) + var(tx_in["scriptsig"]) + le(tx_in["sequence"], 4)
+    raw += f"{len(tx['vout']):02x}"
+    for tx_out in tx["vout"]:
+        raw += le(round(tx_out["value"] * 100000000), 8) + var(tx_out["scriptpubkey"])
+    if segwit:
+        for tx_in in tx["vin"]:
+            raw += f"{len(tx_in['witness']):02x}" + "".join(var(item) for item in tx_in["witness"])
+    return raw + le(tx["locktime"], 4)
+
+# make_offline_tx as raw hex, along with the transaction it spends from
+def make_raw_pair():
+    child = make_offline_tx()
+    parent = make_offline_tx()
+    parent["vin"][0]["witness"] = []
+    parent["vout"] = [child["vin"][0]["prevout"]]
+    parent_hex = serialize_tx(parent)
+    child["vin"][0]["txid"] = txid_from_raw(parent_hex)
+    return parent_hex, serialize_tx(child)
+
+class TestRawTx(unittest.TestCase):
+    def test_is_txid(self):
+        assert is_txid(GENESIS_COINBASE_TXID)
+        assert not is_txid(GENESIS_COINBASE_HEX)
+        assert not is_txid("zz" * 32)
+
+    def test_decode_raw_tx(self):
+        parent_hex, child_hex = make_raw_pair()
+        tx = tx_from_raw(child_hex, lambda txid: parent_hex)
+        expected = make_offline_tx(txid_from_raw(child_hex))
+        del expected["status"]
+        expected["vin"][0]["txid"] = txid_from_raw(parent_hex)
+        expected["vin"][0]["prevout"]["scriptpubkey_type"] = "witness_v0_keyhash"
+        # only the hex of the scriptSig is decoded
+        del expected["vin"][0]["scriptsig_asm"]
+        expected["vout"][0]["scriptpubkey_type"] = "witness_v0_keyhash"
+        assert tx == expected
+
+        with self.assertRaises(ValueError):
+            tx_from_raw(GENESIS_COINBASE_HEX, lambda txid: parent_hex)
+
+    def test_script_type(self):
+        assert get_script_type(bytes.fromhex("76a914" + "11" * 20 + "88ac")) == "pubkeyhash"
+        assert get_script_type(bytes.fromhex("5120" + "11" * 32)) == "witness_v1_taproot"
+        assert get_script_type(bytes.fromhex("51024e73")) == "anchor"
+        assert get_script_type(bytes.fromhex("5210" + "11" * 16)) == "witness_unknown"
+        assert get_script_type(bytes.fromhex("6a00")) == "nulldata"
+        assert get_script_type(bytes.fromhex(push(COMPRESSED_PUBKEY) + "ac")) == "pubkey"
+        assert get_script_type(bytes.fromhex("51" + push(COMPRESSED_PUBKEY) + push(UNCOMPRESSED_PUBKEY) + "52ae")) == "multisig"
+        assert get_script_type(bytes.fromhex("ac")) == "nonstandard"
+
+    def test_txid_from_raw(self):
+        assert txid_from_raw(GENESIS_COINBASE_HEX) == GENESIS_COINBASE_TXID
+
+        # adding a marker, flag and an (empty) witness must not change the txid
+        segwit_hex = GENESIS_COINBASE_HEX[:8] + "0001" + GENESIS_COINBASE_HEX[8:-8] + "00" + GENESIS_COINBASE_HEX[-8:]
+        assert txid_from_raw(segwit_hex) == GENESIS_COINBASE_TXID
+
+class TestBatch(unittest.TestCase):
+    def test_banner_on_stderr(self):
+        # stdout carries the verdicts, so picking a backend mustn't write to it
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            fetch_txs.select_backend()
+        assert stdout.getvalue() == ""
+        assert stderr.getvalue().startswith("Using ")
+
+    def test_classify_stream(self):
+        requested = []
+        def get_tx(txid):
+            requested.append(txid)
+            return make_offline_tx(txid)
+
+        parent_hex, child_hex = make_raw_pair()
+        requested_raw = []
+        def get_raw_tx(txid):
+            requested_raw.append(txid)
+            return parent_hex
+
+        def get_height(txid):
+            raise KeyError(txid)
+
+        out = io.StringIO()
+        lines = ["aa" * 32, child_hex, GENESIS_COINBASE_HEX, "not a transaction", "BB" * 32]
+        totals = classify_stream(iter(lines), out, window=2, get_tx=get_tx, get_raw_tx=get_raw_tx, get_height=get_height)
+
+        verdicts = [json.loads(line) for line in out.getvalue().splitlines()]
+        child_txid = txid_from_raw(child_hex)
+        assert [verdict.get("txid") for verdict in verdicts] == ["aa" * 32, child_txid, None, None, "bb" * 32]
+        assert "coinbase" in verdicts[2]["error"]
+        assert "error" in verdicts[3]
+        # the raw transaction itself is never fetched, only its parent
+        assert sorted(requested) == sorted(["aa" * 32, "bb" * 32])
+        assert requested_raw == [txid_from_raw(parent_hex)]
+        assert verdicts[0]["wallet"] == get_wallet_label(detect_wallet(make_offline_tx())[0]).value
+        assert verdicts[1]["wallet"] == verdicts[0]["wallet"]
+        assert verdicts[1]["height"] == -1
+        assert totals["Error"] == 2
+        assert sum(totals.values()) == len(lines)
+
+class TestResultTable(unittest.TestCase):
+    def test_round_trip(self):
+        table = ResultTable(capacity=1)
+        table.append("aa" * 32, {Wallets.LEDGER}, ["nVersion = 1", "Spends P2PKH output"], 800000)
+        table.append("bb" * 32, {Wallets.BITCOIN_CORE, Wallets.ELECTRUM}, ["nVersion = 2"])
+        table.append("cc" * 32, {Wallets.OTHER}, ["non-standard nVersion number"], 800001)
+
+        assert len(table) == 3
+        assert table.txid(0) == "aa" * 32
+        assert table.candidates(1) == {Wallets.BITCOIN_CORE, Wallets.ELECTRUM}
+        assert table.reasoning(0) == ["nVersion = 1", "Spends P2PKH output"]
+        assert table.totals()[Wallets.UNCLEAR.value] == 1
+        assert table.txids_for(Wallets.LEDGER) == ["aa" * 32]
+
+        with tempfile.TemporaryDirectory() as path:
+            table.save(path)
+            loaded = ResultTable.load(path)
+            assert loaded.to_dict() == table.to_dict()
+            assert list(loaded.column("heights")) == [800000, -1, 800001]
+            assert loaded.reasoning(2) == ["non-standard nVersion number"]
+
+            # appending to a memory-mapped table copies it out first
+            loaded.append("dd" * 32, {Wallets.TREZOR}, [])
+            assert loaded.txids_for(Wallets.TREZOR) == ["dd" * 32]
+
+    def test_fixed_reasons(self):
+        table = ResultTable()
+        chain = SyntheticChain(seed=2)
+        set_active_index(chain.index)
+        try:
+            for tx, wallet in chain.iter_transactions(200):
+                wallet, reasoning = detect_wallet(tx)
+                table.append(tx["txid"], wallet, reasoning)
+                # in the same order as detect_wallet, whichever reasons came first
+                assert table.reasoning(len(table) - 1) == reasoning
+        finally:
+            set_active_index(None)
+            chain.index.close()
+        assert table.reasons == REASONS
+
+        with tempfile.TemporaryDirectory() as path:
+            table.save(path)
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+            meta["reasons"] = meta["reasons"][::-1]
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            with self.assertRaises(ValueError):
+                ResultTable.load(path)
+
+    def test_batch_results(self):
+        table = ResultTable()
+        classify_stream(iter(["aa" * 32, "not a transaction"]), io.StringIO(), get_tx=make_offline_tx, results=table)
+        assert len(table) == 1
+        assert table.candidates(0) == detect_wallet(make_offline_tx())[0]
+
 if __name__ == '__main__':
     unittest.main()